@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# build synthetic repositories for the benchmarks
+#
+#   python benchmarks/generate.py /tmp/repo --files 2000 --depth 4 --commits 200 --branches 3
+#
+# files are spread over directories up to --depth deep, each about --blob-size bytes of text.
+# after an initial commit of every file, --commits commits are made round-robin on master and
+# --branches branches forked from it, each changing a few lines in files only it owns (so merges
+# never conflict). every --merge-every commits, all branches are merged into master.
+# --history adds a line of that many empty commits with 2 short branches off its tip
+# (history-a and history-b), for merge-base and push on long histories
+
+import os
+import sys
+import random
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from ugit import data, base
+
+
+# make a line of count commits of an empty tree and 2 branches of branch_length commits
+# forked from its tip, return the fork point and the 2 branch tips
+def make_history(count, branch_length):
+    tree = data.hash_object(b"", "tree")
+    def commit(parents, msg):
+        body = f"tree {tree}\n" + "".join(f"parent {p}\n" for p in parents) + f"\n{msg}\n"
+        return data.hash_object(body.encode(), "commit")
+
+    parent = None
+    for i in range(count):
+        parent = commit([parent] if parent else [], f"trunk {i}")
+    fork = parent
+
+    tips = []
+    for name in ("a", "b"):
+        tip = fork
+        for i in range(branch_length):
+            tip = commit([tip], f"{name} {i}")
+        tips.append(tip)
+    return fork, tips
+
+
+# build a repository in path (which must not exist), the working tree is left on master
+def generate_repo(path, files=500, depth=3, blob_size=4096, commits=50, branches=2,
+                  merge_every=10, history=0, seed=0):
+    rng = random.Random(seed)
+    path = os.path.abspath(path)
+    os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        with open(os.devnull, "w") as devnull, data.change_git_dir(path), contextlib.redirect_stdout(devnull):
+            base.init()
+            paths = [_random_path(rng, i, depth) for i in range(files)]
+            for p in paths:
+                _write_blob(rng, p, blob_size)
+            base.commit("initial commit")
+
+            names = ["master"] + [f"branch{k}" for k in range(branches)]
+            HEAD = data.get_ref("HEAD").value
+            for name in names[1:]:
+                base.create_branch(name, HEAD)
+
+            # each branch only changes its own files so merges apply cleanly
+            owned = {name: paths[k::len(names)] or paths for k, name in enumerate(names)}
+            for i in range(commits):
+                name = names[i % len(names)]
+                base.checkout(name)
+                change_files(rng, owned[name], max(1, len(owned[name]) // 20))
+                base.commit(f"commit {i} on {name}")
+
+                if branches and merge_every and (i + 1) % merge_every == 0:
+                    base.checkout("master")
+                    for other in names[1:]:
+                        base.merge(data.get_ref(f"refs/heads/{other}").value)
+                        if data.get_ref("MERGE_HEAD").value:
+                            base.commit(f"merge {other}")
+
+            if history:
+                _, (a, b) = make_history(history, 5)
+                base.create_branch("history-a", a)
+                base.create_branch("history-b", b)
+
+            base.checkout("master")
+            data.repack()
+    finally:
+        os.chdir(cwd)
+    return path
+
+
+def _random_path(rng, i, depth):
+    dirs = [f"dir{rng.randrange(5)}" for _ in range(rng.randint(0, depth))]
+    return "/".join(dirs + [f"file{i}.txt"])
+
+
+def _write_blob(rng, path, blob_size):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    size = rng.randint(blob_size // 2, blob_size * 3 // 2)
+    lines = []
+    while size > 0:
+        line = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(3, 12))) + "\n"
+        lines.append(line)
+        size -= len(line)
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+# replace one line in each of count files
+def change_files(rng, paths, count):
+    for path in rng.sample(paths, min(count, len(paths))):
+        with open(path) as f:
+            lines = f.readlines()
+        lines[rng.randrange(len(lines))] = f"changed {rng.random()}\n"
+        with open(path, "w") as f:
+            f.writelines(lines)
+
+
+_WORDS = (
+    "tree blob commit parent branch merge index object pack delta ref head tag graph "
+    "diff patch hunk line file path oid hash zlib stream cache fetch push remote"
+).split()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    add_generator_args(parser)
+    args = parser.parse_args()
+    generate_repo(args.path, **generator_options(args))
+    print(f"Generated repository in {os.path.abspath(args.path)}")
+
+
+def add_generator_args(parser):
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--blob-size", type=int, default=4096)
+    parser.add_argument("--commits", type=int, default=50)
+    parser.add_argument("--branches", type=int, default=2)
+    parser.add_argument("--merge-every", type=int, default=10)
+    parser.add_argument("--history", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def generator_options(args):
+    return {
+        name: getattr(args, name)
+        for name in ("files", "depth", "blob_size", "commits", "branches", "merge_every", "history", "seed")
+    }
+
+
+if __name__ == "__main__":
+    main()
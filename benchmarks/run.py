@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# time ugit operations on a synthetic repository (see generate.py)
+#
+#   python benchmarks/run.py --output results.json
+#   python benchmarks/run.py --baseline results.json --threshold 0.2
+#   python benchmarks/run.py --scenarios status log --files 5000 --repeat 5
+#
+# the repository is generated once, then every run of a scenario works on a fresh copy of it,
+# so scenarios that change the repository don't affect each other. the setup of a scenario
+# (copying, making changes to commit...) is not timed. results are the min, median and max
+# seconds of --repeat runs. with --baseline, any scenario whose median is more than
+# --threshold slower than in the baseline is reported and the exit status is 1
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from ugit import data, base, cli, remote
+from generate import generate_repo, add_generator_args, generator_options, change_files
+
+
+# each scenario takes the path of a fresh copy of the repository (which is also the current
+# directory and GIT_DIR) and returns the function to time
+
+def commit(repo):
+    change_files(random.Random(1), _tracked_files(), 10)
+    return lambda: base.commit("benchmark commit")
+
+
+def status(repo):
+    change_files(random.Random(1), _tracked_files(), 10)
+    return lambda: cli.status(argparse.Namespace(jobs=None))
+
+
+def log(repo):
+    return lambda: cli.log(argparse.Namespace(oid=base.get_oid("@"), paths=[]))
+
+
+def log_path(repo):
+    base.write_commit_graph()
+    path = sorted(_tracked_files())[0]
+    return lambda: cli.log(argparse.Namespace(oid=base.get_oid("@"), paths=[path]))
+
+
+def checkout(repo):
+    return lambda: base.checkout(_other_branch())
+
+
+def merge(repo):
+    rng = random.Random(1)
+    other = _other_branch()
+    base.checkout(other)
+    change_files(rng, [p for p in _tracked_files() if p.endswith(("1.txt", "3.txt"))], 5)
+    base.commit("benchmark change on branch")
+    base.checkout("master")
+    change_files(rng, [p for p in _tracked_files() if p.endswith(("0.txt", "2.txt"))], 5)
+    base.commit("benchmark change on master")
+    oid = data.get_ref(f"refs/heads/{other}").value
+    return lambda: base.merge(oid)
+
+
+def merge_base(repo):
+    master = data.get_ref("refs/heads/master").value
+    other = data.get_ref(f"refs/heads/{_other_branch()}").value
+    return lambda: base.get_merge_base(master, other)
+
+
+def merge_base_history(repo):
+    a = data.get_ref("refs/heads/history-a").value
+    b = data.get_ref("refs/heads/history-b").value
+    assert a and b, "Generate the repository with --history to run this scenario"
+    return lambda: base.get_merge_base(a, b)
+
+
+def merge_base_history_graph(repo):
+    base.write_commit_graph()
+    return merge_base_history(repo)
+
+
+# fetch everything into an empty repository
+def fetch(repo):
+    client = f"{repo}-client"
+    os.makedirs(client)
+    os.chdir(client)
+    # the timed function runs after setup returns, so switch GIT_DIR for the rest of the run
+    data.GIT_DIR = f"{client}/.ugit"
+    base.init()
+    return lambda: remote.fetch(repo)
+
+
+# push one new commit to a copy of the repository
+def push(repo):
+    server = f"{repo}-server"
+    shutil.copytree(repo, server)
+    change_files(random.Random(1), _tracked_files(), 10)
+    base.commit("benchmark commit")
+    return lambda: remote.push(server, "refs/heads/master")
+
+
+# push one new commit on top of the --history line to a copy of the repository
+def push_history(repo):
+    tip = data.get_ref("refs/heads/history-a").value
+    assert tip, "Generate the repository with --history to run this scenario"
+    server = f"{repo}-server"
+    shutil.copytree(repo, server)
+    blob = data.hash_object(b"new content\n")
+    tree = data.hash_object(f"blob {blob} file\n".encode(), "tree")
+    oid = data.hash_object(f"tree {tree}\nparent {tip}\n\none more commit\n".encode(), "commit")
+    data.update_ref("refs/heads/history-a", data.RefValue(symbolic=False, value=oid))
+    return lambda: remote.push(server, "refs/heads/history-a")
+
+
+# print every blob of HEAD with cat_file --batch
+def cat_file_batch(repo):
+    names = "".join(f"{oid}\n" for oid in base.get_tree(base.get_commit(base.get_oid("@")).tree).values())
+    def run():
+        with _stdin(names):
+            cli.cat_file(argparse.Namespace(oid=None, batch=True, batch_check=False))
+    return run
+
+
+SCENARIOS = {
+    "commit": commit,
+    "status": status,
+    "log": log,
+    "log_path": log_path,
+    "checkout": checkout,
+    "merge": merge,
+    "merge_base": merge_base,
+    "merge_base_history": merge_base_history,
+    "merge_base_history_graph": merge_base_history_graph,
+    "fetch": fetch,
+    "push": push,
+    "push_history": push_history,
+    "cat_file_batch": cat_file_batch,
+}
+# scenarios that need a generator option to be set
+REQUIRES = {"merge_base_history": "history", "merge_base_history_graph": "history", "push_history": "history"}
+
+
+def _tracked_files():
+    return list(base.get_tree(base.get_commit(base.get_oid("@")).tree))
+
+
+@contextlib.contextmanager
+def _stdin(text):
+    stdin, sys.stdin = sys.stdin, io.StringIO(text)
+    try:
+        yield
+    finally:
+        sys.stdin = stdin
+
+
+def _other_branch():
+    names = sorted(name for name in base.iter_branch_names() if name.startswith("branch"))
+    assert names, "Generate the repository with --branches to run this scenario"
+    return names[0]
+
+
+# run a scenario on a fresh copy of the repository, return the seconds taken
+def run_once(setup, repo, tmp):
+    copy = tempfile.mkdtemp(dir=tmp)
+    os.rmdir(copy)
+    shutil.copytree(repo, copy)
+    cwd = os.getcwd()
+    os.chdir(copy)
+    # caches are keyed by oid and shared by every copy, start each run cold
+    for c in (data.objects_cache, data.delta_base_cache, base.commits_cache, base.trees_cache):
+        c.clear()
+    base._generations.clear()
+    try:
+        with open(os.devnull, "w") as devnull, data.change_git_dir(copy), contextlib.redirect_stdout(devnull):
+            func = setup(copy)
+            start = time.perf_counter()
+            func()
+            return time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+
+def run(repo, names, repeat, tmp):
+    results = {}
+    for name in names:
+        times = [run_once(SCENARIOS[name], repo, tmp) for _ in range(repeat)]
+        results[name] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "max": max(times),
+            "runs": len(times),
+        }
+        print(f"{name:<28} {results[name]['median']:9.4f}s  (min {results[name]['min']:.4f}s)")
+    return results
+
+
+# return the scenarios whose median got slower than the baseline by more than threshold (a fraction)
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"\n{'scenario':<28} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]["median"], result["median"]
+        change = (after - before) / before if before else 0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<28} {before:9.4f}s {after:9.4f}s {change:+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_generator_args(parser)
+    parser.add_argument("--scenarios", nargs="*", choices=sorted(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    options = generator_options(args)
+    names = args.scenarios or [
+        name for name in SCENARIOS if not REQUIRES.get(name) or options[REQUIRES[name]]
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        repo = generate_repo(f"{tmp}/repo", **options)
+        print(f"{'generate repository':<28} {time.perf_counter() - start:9.4f}s")
+        results = run(repo, names, args.repeat, tmp)
+
+    report = {
+        "options": options,
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["options"] != options:
+            print("\nWARNING: the baseline was generated with different options")
+        regressions = compare(results, baseline["scenarios"], args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
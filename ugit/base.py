@@ -1,11 +1,20 @@
 import os
-import pathlib
+import stat
+import time
 import itertools
 import operator
 import string
-from collections import deque, namedtuple
+import heapq
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from . import data
 from . import diff
+from . import commit_graph
+from . import cache
+from . import bloom
+from . import trace
+from . import ignore
+from . import fsmonitor
 
 
 def init():
@@ -13,42 +22,32 @@ def init():
     data.update_ref("HEAD", data.RefValue(symbolic=True, value="refs/heads/master"))
 
 
-# recursively hash and store the content of directory inside object DB
-# And store all hashes, type of object and name for objects in new object with type tree
-def write_tree (directory='.'):
-    entries = []
-    it = os.scandir(directory)
-    for entry in it:
-        full = f'{directory}/{entry.name}'
-        if is_ignored(full): continue
-        if entry.is_file(follow_symlinks=False):
-            _type = "blob"
-            with open(full, "rb") as f:
-                oid = data.hash_object(f.read())
-        elif entry.is_dir(follow_symlinks=False):
-            _type = "tree"
-            oid = write_tree(full)
+# store the working tree as tree objects and return the oid of the root tree
+# the index keeps the oid of every directory (the cached tree), only directories
+# with something changed beneath them are written again
+def write_tree(jobs=None):
+    with data.get_index() as index:
+        with trace.phase("update_index"):
+            paths = _update_index(index, jobs)
+        with trace.phase("write_trees"):
+            return _write_tree_from_paths(paths, index)
 
-        entries.append((entry.name, oid, _type))
-    it.close()
-
-    # Create the Tree object
-    tree = "".join((f"{_type} {oid} {name}\n" for name, oid, _type in sorted(entries) ))
-    print("WRITE TREE")
-    print(tree)
-    # oid of current directory which stores files and sub-trees oids
-    return data.hash_object(tree.encode(), "tree")
 
+# parsed commits and tree entries, sized by the length of the object they were parsed from
+commits_cache = cache.LRUCache("commits", int(os.environ.get("UGIT_COMMIT_CACHE_SIZE", 16 << 20)))
+trees_cache = cache.LRUCache("trees", int(os.environ.get("UGIT_TREE_CACHE_SIZE", 32 << 20)))
 
 
 # parse a tree object and yield _type, oid, name for each entry inside tree object
 def _iter_tree_entries(oid):
     if not oid:
         return None
-    tree = data.get_object(oid, "tree")
-    for entry in tree.decode().splitlines():
-        _type, oid, name = entry.split(" ", 2)
-        yield _type, oid, name
+    entries = trees_cache.get(oid)
+    if entries is None:
+        tree = data.get_object(oid, "tree")
+        entries = tuple(tuple(entry.split(" ", 2)) for entry in tree.decode().splitlines())
+        trees_cache.put(oid, entries, len(tree))
+    yield from entries
 
 
 # take tree oid and collects path and oid to each entry inside tree in a dict()
@@ -68,52 +67,269 @@ def get_tree(oid, base_path=""):
     return result
 
 
-# traverse current directory, write each file to DB and store file in a hashtable
-def get_working_tree():
-    result = {}
-    for root, _, filenames in os.walk("."):
+# walk 2 trees side by side and yield (path, o_from, o_to) for every blob that differs
+# subtrees with the same oid on both sides are skipped without being read
+def iter_tree_changes(t_from, t_to, base_path=""):
+    if t_from == t_to:
+        return
+    entries_from = {name: (_type, oid) for _type, oid, name in _iter_tree_entries(t_from)}
+    entries_to = {name: (_type, oid) for _type, oid, name in _iter_tree_entries(t_to)}
+    for name in sorted(entries_from.keys() | entries_to.keys()):
+        type_from, o_from = entries_from.get(name, (None, None))
+        type_to, o_to = entries_to.get(name, (None, None))
+        if o_from == o_to:
+            continue
+        path = base_path + name
+        # a blob replaced by a tree (or the opposite) is a deleted file plus new files
+        if type_from == "blob" or type_to == "blob":
+            yield (
+                path,
+                o_from if type_from == "blob" else None,
+                o_to if type_to == "blob" else None,
+            )
+        if type_from == "tree" or type_to == "tree":
+            yield from iter_tree_changes(
+                o_from if type_from == "tree" else None,
+                o_to if type_to == "tree" else None,
+                f"{path}/",
+            )
+
+
+# build and store tree objects from a dict of path to blob oid, return oid of the root tree
+# directories found in index["trees"] are reused without being written again
+def _write_tree_from_paths(paths, index):
+    trees = index.setdefault("trees", {})
+    root = {}
+    for path, oid in paths.items():
+        *dirnames, name = path.split("/")
+        node = root
+        for dirname in dirnames:
+            node = node.setdefault(dirname, {})
+        node[name] = oid
+
+    def write(node, path):
+        if path in trees:
+            return trees[path]
+        entries = [
+            (name, write(value, f"{path}{name}/"), "tree") if isinstance(value, dict) else (name, value, "blob")
+            for name, value in node.items()
+        ]
+        tree = "".join(f"{_type} {oid} {name}\n" for name, oid, _type in sorted(entries))
+        trees[path] = data.hash_object(tree.encode(), "tree")
+        index["dirty"] = True
+        return trees[path]
+
+    return write(root, "")
+
+
+# traverse current directory and collect path and oid of each file in a hashtable
+def get_working_tree(jobs=None):
+    with data.get_index() as index:
+        return _update_index(index, jobs)
+
+
+# stat every file in the working tree and update the index
+# files whose stat data matches the index are answered from the index, only dirty files get rehashed
+# with jobs > 1, dirty files are read and hashed by a pool of threads while the walk goes on
+# when `ugit fsmonitor` runs, only the paths it saw change since the last update are looked at
+def _update_index(index, jobs=None):
+    entries = index["entries"]
+    changed = set()
+    hashed = []
+    with trace.phase("fsmonitor"):
+        token, reported = fsmonitor.query(index.get("fsmonitor"))
+    if token != index.get("fsmonitor"):
+        index["fsmonitor"] = token
+        index["dirty"] = True
+
+    pool = ThreadPoolExecutor(jobs) if jobs and jobs > 1 else None
+
+    # queue path for hashing unless its stat data matches the index, false if it isn't a file
+    def visit(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        entry = entries.get(path)
+        if not (entry and _is_clean(entry, st, index["mtime"])):
+            hashed.append((path, st, pool.submit(_hash_file, path) if pool else _hash_file(path)))
+        return True
+
+    try:
+        matcher = ignore.get_matcher()
+        if reported is None:
+            seen = {path for path in _iter_working_files(".", matcher) if visit(path)}
+            gone = entries.keys() - seen
+        else:
+            # a reported directory was created, moved or deleted, look at everything under it
+            seen, checked = set(), set()
+            for path in reported:
+                is_dir = os.path.isdir(path) and not os.path.islink(path)
+                if matcher.is_ignored(path, is_dir):
+                    continue
+                checked.add(path)
+                if is_dir:
+                    seen.update(p for p in _iter_working_files(path, matcher) if visit(p))
+                elif visit(path):
+                    seen.add(path)
+            prefixes = tuple(f"{path}/" for path in checked)
+            gone = {
+                path for path in entries.keys() - seen
+                if path in checked or path.startswith(prefixes)
+            }
+
+        for path, st, oid in hashed:
+            if pool:
+                oid = oid.result()
+            entry = entries.get(path)
+            if not entry or entry[3] != oid:
+                changed.add(path)
+            entries[path] = [st.st_size, st.st_mtime_ns, st.st_ino, oid]
+            index["dirty"] = True
+    finally:
+        if pool:
+            pool.shutdown()
+
+    # forget about files that no longer exist
+    for path in gone:
+        del entries[path]
+        changed.add(path)
+        index["dirty"] = True
+
+    _invalidate_trees(index, changed)
+    return {path: entry[3] for path, entry in entries.items()}
+
+
+# yield the path of every file under top that isn't ignored
+def _iter_working_files(top, matcher):
+    for dirpath, _, filenames in ignore.walk(top, matcher):
+        prefix = f"{dirpath}/" if dirpath else ""
         for filename in filenames:
-            path = os.path.relpath(f"{root}/{filename}")
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            with open(path, "rb") as f:
-                result[path] = data.hash_object(f.read())
-
-    return result
+            yield prefix + filename
+
+
+def _hash_file(path):
+    with open(path, "rb") as f:
+        return data.hash_object_stream(f)
+
+
+# drop the cached tree oid of every directory above the changed paths, return their keys
+def _invalidate_trees(index, paths):
+    trees = index.setdefault("trees", {})
+    dropped = set()
+    for path in paths:
+        dirname = path
+        while dirname:
+            dirname = dirname.rpartition("/")[0]
+            key = f"{dirname}/" if dirname else ""
+            if key in dropped:
+                break
+            trees.pop(key, None)
+            dropped.add(key)
+    return dropped
+
+
+# cache the oid of the directories of dirnames (index["trees"] keys, every parent of a directory
+# included) from tree, which the index entries must match
+def _cache_trees(index, tree, dirnames):
+    trees = index.setdefault("trees", {})
+    def fill(oid, path):
+        trees[path] = oid
+        for _type, child, name in _iter_tree_entries(oid):
+            if _type == "tree" and f"{path}{name}/" in dirnames:
+                fill(child, f"{path}{name}/")
+
+    if "" in dirnames:
+        fill(tree, "")
+
+
+# an index entry can be trusted if size, mtime and inode match what is on disk
+# a file modified in the same mtime tick the index was written in is "racily clean", so it must be rehashed
+# (entries that were racy when the index was written have their size smudged to -1, see data.get_index)
+def _is_clean(entry, st, index_mtime):
+    size, mtime, ino, _ = entry
+    if (size, mtime, ino) != (st.st_size, st.st_mtime_ns, st.st_ino):
+        return False
+    return mtime < index_mtime
+
+# number of files from which checkout writes files with a pool of threads
+PARALLEL_WRITE_THRESHOLD = 64
+
+
+# write the content of a tree to the working directory
+# only paths that differ between the index (what was last checked out or seen) and tree_oid
+# are removed, created or overwritten
+def read_tree(tree_oid):
+    with trace.phase("update_working_tree"):
+        _update_working_tree(tree_oid)
+
+
+def _update_working_tree(t_to):
+    with data.get_index() as index:
+        entries = index["entries"]
+        # the cached trees of the index make this cheap, only changed directories are written
+        t_from = _write_tree_from_paths({path: entry[3] for path, entry in entries.items()}, index)
+        changes = list(iter_tree_changes(t_from, t_to))
+        _write_changes(changes)
+
+        # record what was written so the next status doesn't rehash it
+        for path, o_from, o_to in changes:
+            if o_to:
+                st = os.stat(path)
+                entries[path] = [st.st_size, st.st_mtime_ns, st.st_ino, o_to]
+            else:
+                entries.pop(path, None)
+        dropped = _invalidate_trees(index, (path for path, _, _ in changes))
+        if changes:
+            # the entries now hold exactly the content of t_to, so its trees are the cached trees
+            _cache_trees(index, t_to, dropped)
+            index["dirty"] = True
+
+
+def _write_changes(changes):
+    # remove first, a file might be replaced by a directory of the same name
+    for path, o_from, o_to in changes:
+        if not o_to:
+            _remove_file(path)
+
+    to_write = [(path, o_to) for path, _, o_to in changes if o_to]
+    for dirname in {os.path.dirname(path) for path, _ in to_write}:
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+    if len(to_write) < PARALLEL_WRITE_THRESHOLD:
+        written = [_write_file(path, oid) for path, oid in to_write]
+    else:
+        with ThreadPoolExecutor() as pool:
+            written = list(pool.map(lambda change: _write_file(*change), to_write))
+    for path, _bytes in zip((path for path, _ in to_write), written):
+        print(f"writing {_bytes} bytes to {path}")
 
-# delete everything in the current directory except for ignored files
-def _empty_current_directory():
-    for root, dirnames, filenames in os.walk(".", topdown=False):
-        for filename in filenames:
-            path = os.path.relpath(f"{root}/{filename}")
-            if is_ignored(path) or not os.path.isfile(path):
-                continue
-            os.remove(path)
 
-        for dirname in dirnames:
-            path = os.path.relpath(f"{root}/{dirname}")
-            if is_ignored(path):
-                continue
-            try:
-                os.rmdir(path)
-            except (FileNotFoundError, OSError):
-                # deleting might fail if directory containes ignored files
-                pass
+def _write_file(path, oid):
+    with open(path, "wb") as out:
+        return sum(out.write(chunk) for chunk in data.iter_object(oid))
 
 
-# uses get_tree to get oids and path and write the content of each oid to working directory
-def read_tree(tree_oid):
-    _empty_current_directory()
-    for path, oid in get_tree(tree_oid, base_path="./").items():
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "wb") as out:
-            _bytes = out.write(data.get_object(oid))
-            print(f"writing {_bytes} bytes to {path}")
+# remove a file and the directories above it that became empty
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    try:
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.removedirs(dirname)
+    except OSError:
+        # directory still contains files (could be ignored or untracked ones)
+        pass
 
 
 # calls write_tree, take oid returend and a message and store it as a new object in the database of type commit
-def commit(msg):
-    commit = f"tree {write_tree()}\n"
+def commit(msg, jobs=None):
+    commit = f"tree {write_tree(jobs)}\n"
     HEAD = data.get_ref("HEAD").value
     if HEAD:
         commit += f"parent {HEAD}\n"
@@ -125,13 +341,18 @@ def commit(msg):
     commit += f"{msg}\n"
     oid = data.hash_object(commit.encode(), "commit")
     data.update_ref("HEAD", data.RefValue(symbolic=False, value=oid))
+    # keep the commit-graph up to date once it was written
+    if commit_graph.exists():
+        with trace.phase("commit_graph"):
+            update_commit_graph({oid})
     return oid
 
 
 def merge(other):
     HEAD = data.get_ref("HEAD").value
     assert HEAD
-    merge_base = get_merge_base(other, HEAD)
+    with trace.phase("merge_base"):
+        merge_base = get_merge_base(other, HEAD)
     c_other = get_commit(other)
     # Handle fast-forward merge
     if merge_base == HEAD:
@@ -143,31 +364,163 @@ def merge(other):
     data.update_ref("MERGE_HEAD", data.RefValue(symbolic=False, value=other))
     c_base = get_commit(merge_base)
     c_HEAD = get_commit(HEAD)
-    read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree)
+    conflicts = read_tree_merged(c_base.tree, c_HEAD.tree, c_other.tree)
+    for conflict in conflicts:
+        print(f"CONFLICT ({conflict.kind}): Merge conflict in {conflict.path}")
     print("Merged in working tree\nPlease commit")
 
 
 # given 2 commit oids, find/return the first common parent
 def get_merge_base(c1, c2):
-    c1_parents = list(iter_commits_and_parents({c1}))
-    for oid in iter_commits_and_parents({c2}):
-        if oid in c1_parents:
-            return oid
+    bases = get_merge_bases(c1, [c2])
+    return bases[0] if bases else None
+
+
+# flags used while painting history in get_merge_bases
+_PARENT1, _PARENT2, _STALE, _RESULT = 1, 2, 4, 8
+
+# return the best common ancestors of one and any of others (none of them is an ancestor of another)
+# walks both sides at the same time from the highest generation down, and stops
+# as soon as everything left to walk is known to be an ancestor of a common ancestor
+# (generations are read from the commit-graph, without one they cost a walk of all of history)
+def get_merge_bases(one, others):
+    if one in others:
+        return [one]
+
+    flags = defaultdict(int)
+    queue = []
+    queued = set()
+    # number of queued commits that aren't stale, the walk ends when it drops to 0
+    active = 0
+    def push(oid, flag):
+        nonlocal active
+        was_stale = flags[oid] & _STALE
+        flags[oid] |= flag
+        # a queued commit is only walked once, with all the flags it got by then
+        if oid in queued:
+            if not was_stale and flags[oid] & _STALE:
+                active -= 1
+            return
+        queued.add(oid)
+        heapq.heappush(queue, (-get_generation(oid), oid))
+        if not flags[oid] & _STALE:
+            active += 1
+
+    push(one, _PARENT1)
+    for oid in others:
+        push(oid, _PARENT2)
+
+    results = []
+    while active:
+        _, oid = heapq.heappop(queue)
+        queued.discard(oid)
+        if not flags[oid] & _STALE:
+            active -= 1
+        flag = flags[oid] & (_PARENT1 | _PARENT2 | _STALE)
+        if flag == _PARENT1 | _PARENT2:
+            if not flags[oid] & _RESULT:
+                flags[oid] |= _RESULT
+                results.append(oid)
+            # everything below a common ancestor is a worse one
+            flag |= _STALE
+        for parent in get_parents(oid):
+            if flags[parent] & flag == flag:
+                continue
+            push(parent, flag)
+
+    # a result that got painted stale is an ancestor of another result
+    results = [oid for oid in results if not flags[oid] & _STALE]
+    return _remove_redundant(results)
+
+
+# merge bases of all commits together, for octopus merges
+def get_octopus_merge_bases(oids):
+    oids = list(oids)
+    bases = oids[:1]
+    for oid in oids[1:]:
+        candidates = []
+        for base in bases:
+            candidates.extend(c for c in get_merge_bases(base, [oid]) if c not in candidates)
+        bases = _remove_redundant(candidates)
+    return bases
+
+
+# drop commits that are ancestors of other commits in the list, best (highest generation) first
+def _remove_redundant(oids):
+    oids = sorted(oids, key=get_generation, reverse=True)
+    result = []
+    for oid in oids:
+        if not any(is_ancestor(oid, other) for other in result):
+            result.append(oid)
+    return result
 
 
-# given 2 and a common parent trees, will merge and write to working dir
+# check if ancestor is reachable from oid, never walking below the generation of ancestor
+def is_ancestor(ancestor, oid):
+    min_generation = get_generation(ancestor)
+    oids = [oid]
+    visited = set()
+    while oids:
+        oid = oids.pop()
+        if oid == ancestor:
+            return True
+        if oid in visited or get_generation(oid) <= min_generation:
+            continue
+        visited.add(oid)
+        oids.extend(get_parents(oid))
+    return False
+
+
+# generation number of a commit (root commits are 1), from the commit-graph when possible
+# commits missing from the graph get it computed from their history once per process
+_generations = {}
+def get_generation(oid):
+    if oid in _generations:
+        return _generations[oid]
+    entry = commit_graph.get_entry(oid)
+    if entry:
+        return entry.generation
+
+    stack = [oid]
+    while stack:
+        current = stack[-1]
+        if current in _generations:
+            stack.pop()
+            continue
+        entry = commit_graph.get_entry(current)
+        if entry:
+            _generations[current] = entry.generation
+            stack.pop()
+            continue
+        parents = get_parents(current)
+        pending = [p for p in parents if p not in _generations]
+        if pending:
+            stack.extend(pending)
+            continue
+        _generations[current] = 1 + max((_generations[p] for p in parents), default=0)
+        stack.pop()
+    return _generations[oid]
+
+
+# given 2 and a common parent trees, will merge and write to working dir, return the conflicts
 def read_tree_merged(t_base, t_HEAD, t_other):
-    _empty_current_directory()
-    merged_tree = diff.merge_trees(get_tree(t_base), get_tree(t_HEAD), get_tree(t_other)).items()
-    for path, blob in merged_tree:
-        os.makedirs(f"./{os.path.dirname(path)}", exist_ok=True)
-        with open(path, "wb") as f:
-            f.write(blob)
+    with trace.phase("merge_trees"):
+        merged_tree, conflicts = diff.merge_trees(get_tree(t_base), get_tree(t_HEAD), get_tree(t_other))
+        merged = _write_tree_from_paths(merged_tree, {})
+    with trace.phase("update_working_tree"):
+        _update_working_tree(merged)
+    return conflicts
 
 
 # parse a commit object and return a commit tuple with tree, parent and msg of commit object
 Commit = namedtuple("Commit", ["tree", "parents", "msg"])
 def get_commit(oid, debug=False):
+    c = commits_cache.get(oid)
+    if c:
+        if debug:
+            print(c)
+        return c
+
     commit = data.get_object(oid, "commit").decode()
     lines = iter(commit.splitlines())
     parents, tree = [], ""
@@ -183,11 +536,88 @@ def get_commit(oid, debug=False):
 
     msg = "\n".join(lines)
     c = Commit(tree=tree, parents=parents, msg=msg)
+    commits_cache.put(oid, c, len(commit))
     if debug:
         print(c)
     return c
 
 
+# return parents of a commit from the commit-graph, parse the commit object if it's not in the graph
+def get_parents(oid):
+    entry = commit_graph.get_entry(oid)
+    if entry:
+        return entry.parents
+    return get_commit(oid).parents
+
+
+def get_commit_tree(oid):
+    entry = commit_graph.get_entry(oid)
+    if entry:
+        return entry.tree
+    return get_commit(oid).tree
+
+
+# write every commit reachable from refs into a single commit-graph file, merging the layers
+# only commits that are not in the graph yet are parsed
+def write_commit_graph():
+    oids = {ref.value for _, ref in data.iter_refs(deref=True)}
+    commits = {oid: (entry.tree, entry.parents) for oid, entry in commit_graph.iter_entries()}
+    blooms = {oid: commit_graph.get_bloom(oid) for oid in commits}
+    _add_new_commits(commits, blooms, oids, commits.__contains__)
+    return commit_graph.write(commits, blooms)
+
+
+# add commits reachable from oids that aren't in the graph yet as a new layer of the commit-graph
+# only the new commits are parsed and written, the existing graph is left as it is
+def update_commit_graph(oids):
+    commits, blooms = {}, {}
+    _add_new_commits(commits, blooms, oids, commit_graph.contains)
+    if commits:
+        commit_graph.append(commits, blooms)
+    return len(commits)
+
+
+# parse the commits reachable from oids until known(oid) says it's already there, adding them to
+# commits with the changed-path filter (see bloom.py) of every commit of commits that lacks one
+def _add_new_commits(commits, blooms, oids, known):
+    oids = deque(oids)
+    while oids:
+        oid = oids.popleft()
+        if not oid or oid in commits or known(oid):
+            continue
+        commit = get_commit(oid)
+        commits[oid] = (commit.tree, commit.parents)
+        oids.extend(commit.parents)
+
+    # filters of the paths changed compared to the first parent
+    for oid, (tree, parents) in commits.items():
+        if blooms.get(oid) is None:
+            parent_tree = get_commit_tree(parents[0]) if parents else None
+            blooms[oid] = bloom.make_filter(path for path, _, _ in iter_tree_changes(parent_tree, tree))
+
+
+# check if a commit changed any of paths (files or directories) compared to its first parent
+# the changed-path filter of the commit-graph rules out most commits without reading their trees
+def commit_changes_paths(oid, paths):
+    bloom_filter = commit_graph.get_bloom(oid)
+    if bloom_filter is not None and not any(bloom.might_contain(bloom_filter, path) for path in paths):
+        return False
+    parents = get_parents(oid)
+    t_from = get_commit_tree(parents[0]) if parents else None
+    t_to = get_commit_tree(oid)
+    return any(_get_path_oid(t_from, path) != _get_path_oid(t_to, path) for path in paths)
+
+
+# return the oid of the blob or tree at path inside a tree, None if there is nothing there
+def _get_path_oid(tree, path):
+    _type, oid = "tree", tree
+    for name in path.split("/"):
+        if _type != "tree" or not oid:
+            return None
+        _type, oid = next(((t, child) for t, child, entry in _iter_tree_entries(oid) if entry == name), (None, None))
+    return oid
+
+
 # get the commit information then read_tree of that commit and set the HEAD to point at that commit
 def checkout(name):
     # if branch name  return oid for branch. if oid return same oid
@@ -237,22 +667,27 @@ def iter_branch_names():
         yield os.path.relpath(refname, "refs/heads")
 
 
-# translate a name to oid or just return that oid if get_ref can't find it
+# the refs a name can stand for, in the order get_oid tries them
+def ref_candidates(name):
+    name = "HEAD" if name == "@" else name
+    return [name, f"refs/{name}", f"refs/tags/{name}", f"refs/heads/{name}"]
+
+
+# translate a name to oid or just return that oid (or the oid an abbreviation resolves to) if get_ref can't find it
 def get_oid(name):
     name = "HEAD" if name == "@" else name
-    refs_to_try = [
-        f"{name}",
-        f"refs/{name}",
-        f"refs/tags/{name}",
-        f"refs/heads/{name}",
-    ]
-    for ref in refs_to_try:
+    for ref in ref_candidates(name):
         if data.get_ref(ref, deref=False).value:
             return data.get_ref(ref, deref=True).value
 
     is_hex = all(c in string.hexdigits for c in name)
     if len(name) == 40 and is_hex:
         return name
+    if data.MIN_ABBREV <= len(name) < 40 and is_hex:
+        matches = data.resolve_prefix(name)
+        assert len(matches) < 2, f"AMBIGUOUS NAME {name}: {', '.join(matches)}"
+        if matches:
+            return matches[0]
     assert False, f"UNKOWN NAME {name}"
 
 
@@ -268,11 +703,11 @@ def iter_commits_and_parents(oids):
         visited.add(oid)
         yield oid
 
-        commit = get_commit(oid)
+        parents = get_parents(oid)
         # RETURN FIRST PARENT NEXT
-        oids.extendleft(commit.parents[:1])
+        oids.extendleft(parents[:1])
         # RETURN OTHER PARENTS LATER
-        oids.extend(commit.parents[1:])
+        oids.extend(parents[1:])
 
 # yields all objects reachable by commit oids (objects != commits)
 def iter_objects_in_commits(oids):
@@ -295,14 +730,137 @@ def iter_objects_in_commits(oids):
     # get commit oids history and traverse it history for objects
     for oid in iter_commits_and_parents(oids):
         yield oid
-        commit = get_commit(oid)
-        if commit.tree not in visited:
-            yield from iter_objects_in_tree(commit.tree)
+        tree = get_commit_tree(oid)
+        if tree not in visited:
+            yield from iter_objects_in_tree(tree)
+
+
+# loose objects newer than this are never pruned, a command running at the same time
+# may have just written them and not referenced them yet
+GC_GRACE_PERIOD = 14 * 24 * 3600
+
+GcResult = namedtuple("GcResult", ["reachable", "pruned", "reclaimed", "timings"])
+
+
+# delete loose objects that no ref (HEAD and MERGE_HEAD included) or index entry can reach
+# and that are older than grace_period seconds. timings holds the seconds taken by each phase
+def gc(grace_period=GC_GRACE_PERIOD):
+    timings = {}
+    started = time.monotonic()
+    with trace.phase("mark"):
+        reachable = set(iter_objects_in_commits({ref.value for _, ref in data.iter_refs(deref=True)}))
+        # the index holds blobs and trees of the next commit
+        with data.get_index() as index:
+            reachable.update(entry[3] for entry in index["entries"].values())
+            reachable.update(index.get("trees", {}).values())
+    timings["mark"] = time.monotonic() - started
+
+    started = time.monotonic()
+    with trace.phase("prune"):
+        pruned, reclaimed = data.prune_loose_objects(reachable, time.time() - grace_period)
+    timings["prune"] = time.monotonic() - started
+    return GcResult(reachable=len(reachable), pruned=pruned, reclaimed=reclaimed, timings=timings)
+
+
+# yields commits and objects reachable from wants that the other side doesn't have
+# the walk stops at commits in haves (tips the other side advertised) or for which
+# has_object(oid) is true, and doesn't descend into trees the other side has
+# (having an object means having everything reachable from it), so the work is
+# proportional to the number of new objects. NOTE: yields oid before reading it.
+def iter_missing_objects(wants, haves, has_object):
+    haves = set(haves)
+    visited = set()
+
+    def iter_objects_in_tree(oid):
+        for _type, oid, _ in _iter_tree_entries(oid):
+            if oid in visited or has_object(oid):
+                continue
+            visited.add(oid)
+            yield oid
+            if _type == "tree":
+                yield from iter_objects_in_tree(oid)
+
+    commits = deque(wants)
+    while commits:
+        oid = commits.popleft()
+        if not oid or oid in visited or oid in haves or has_object(oid):
+            continue
+        visited.add(oid)
+        yield oid
+
+        commits.extend(get_parents(oid))
+        tree = get_commit_tree(oid)
+        if tree not in visited and not has_object(tree):
+            visited.add(tree)
+            yield tree
+            yield from iter_objects_in_tree(tree)
+
+
+# yields commits reachable from wants but not from haves (like `git rev-list wants ^haves`)
+# commits are walked by decreasing generation, so a commit is reached only after all of its
+# descendants and knows whether any have reaches it. the walk stops once every queued commit
+# is reachable from a have. commits reachable from haves that are parents of a yielded commit
+# (the boundary of the walk) are added to boundary
+def iter_commits_excluding(wants, haves, boundary=None):
+    uninteresting = {}
+    queue = []
+    pending = 0
+
+    def add(oid, excluded):
+        nonlocal pending
+        if oid not in uninteresting:
+            uninteresting[oid] = excluded
+            heapq.heappush(queue, (-get_generation(oid), oid))
+            pending += not excluded
+        elif excluded and not uninteresting[oid]:
+            uninteresting[oid] = True
+            pending -= 1
+
+    for oid in haves:
+        add(oid, True)
+    for oid in wants:
+        add(oid, False)
+
+    yielded = []
+    while pending:
+        _, oid = heapq.heappop(queue)
+        excluded = uninteresting[oid]
+        if not excluded:
+            pending -= 1
+            yielded.append(oid)
+            yield oid
+        for parent in get_parents(oid):
+            add(parent, excluded)
+
+    if boundary is not None:
+        boundary.update(p for oid in yielded for p in get_parents(oid) if uninteresting[p])
+
+
+# yields objects reachable from wants that a peer which has haves is missing, for when the
+# peer's object store can't be asked directly. the peer has everything reachable from haves,
+# but only the trees of boundary commits are excluded (walking all of history would defeat
+# the point), so objects reintroduced from older history are sent again
+def iter_objects_excluding(wants, haves):
+    boundary = set()
+    commits = set(iter_commits_excluding(wants, haves, boundary))
+
+    excluded = set(boundary)
+    trees = [get_commit_tree(oid) for oid in boundary]
+    while trees:
+        tree = trees.pop()
+        if tree in excluded:
+            continue
+        excluded.add(tree)
+        for _type, oid, _ in _iter_tree_entries(tree):
+            if _type == "tree":
+                trees.append(oid)
+            else:
+                excluded.add(oid)
+
+    wants = [oid for oid in wants if oid in commits]
+    yield from iter_missing_objects(wants, haves, excluded.__contains__)
 
 
-# check if file or dir is ignored
-def is_ignored(path):
-    ignore = (".ugit", "env", ".git", "ugit")
-    parts = pathlib.Path(path).parts
-    for name in ignore:
-        if name in parts: return True
+# check if file or dir is ignored by .ugitignore (or the default rules)
+def is_ignored(path, is_dir=False):
+    return ignore.get_matcher().is_ignored(os.path.normpath(path).replace(os.sep, "/"), is_dir)
@@ -0,0 +1,41 @@
+import struct
+import hashlib
+
+
+# Bloom filters of the paths a commit changed, stored in the commit-graph
+# every changed file is added along with its parent directories, so a filter can answer
+# for a file or a directory. a filter can say "maybe" for a path that didn't change, never "no"
+# for one that did
+BITS_PER_ENTRY = 10
+NUM_HASHES = 7
+# commits changing more paths than this get a filter that always says "maybe"
+MAX_CHANGED_PATHS = 512
+TOO_LARGE = b"\xff"
+
+
+# build a filter from the paths of changed files
+def make_filter(paths):
+    entries = set()
+    for path in paths:
+        parts = path.split("/")
+        entries.update("/".join(parts[:i]) for i in range(1, len(parts) + 1))
+    if len(entries) > MAX_CHANGED_PATHS:
+        return TOO_LARGE
+
+    bits = bytearray(max(1, (len(entries) * BITS_PER_ENTRY + 7) // 8))
+    for entry in entries:
+        for bit in _positions(entry, len(bits) * 8):
+            bits[bit // 8] |= 1 << (bit % 8)
+    return bytes(bits)
+
+
+# false if path (a file or a directory) is certainly not among the changed paths of the filter
+def might_contain(bloom_filter, path):
+    size = len(bloom_filter) * 8
+    return all(bloom_filter[bit // 8] & (1 << (bit % 8)) for bit in _positions(path, size))
+
+
+# double hashing: the i-th position is h1 + i * h2
+def _positions(path, size):
+    h1, h2 = struct.unpack(">II", hashlib.blake2b(path.encode(), digest_size=8).digest())
+    return [(h1 + i * h2) % size for i in range(NUM_HASHES)]
@@ -0,0 +1,62 @@
+import threading
+from collections import OrderedDict
+
+
+# every cache created, so their counters can be reported together
+_caches = {}
+
+
+# least recently used cache bounded by the total size of its values (as given by the caller)
+class LRUCache:
+    def __init__(self, name, max_bytes):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        _caches[name] = self
+
+    # return the cached value or None
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self.size -= old[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+# hits, misses, entries and bytes used of every cache
+def stats():
+    return {
+        name: {
+            "hits": c.hits,
+            "misses": c.misses,
+            "entries": len(c._items),
+            "bytes": c.size,
+            "max_bytes": c.max_bytes,
+        }
+        for name, c in _caches.items()
+    }
@@ -7,20 +7,35 @@ from . import data
 from . import base
 from . import diff
 from . import remote
+from . import server
+from . import fsmonitor
+from . import trace
 
 def main():
     # sets GIT_DIR to `.` and then resets it back when exit `with` block
     with data.change_git_dir("."):
         args = parse_args()
-        args.func(args)
+        trace.start(args.trace)
+        try:
+            with trace.phase(args.command):
+                args.func(args)
+        finally:
+            trace.finish()
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
+    # print where time went, or write it as Chrome trace JSON (same as UGIT_TRACE, see trace.py)
+    parser.add_argument("--trace", action="store_const", const="summary", default=os.environ.get("UGIT_TRACE"))
+    parser.add_argument("--trace-json", dest="trace", metavar="PATH")
     commands = parser.add_subparsers(dest="command")
     commands.required = True
     oid = base.get_oid
 
+    # number of threads/processes used to hash and diff files, also set by UGIT_JOBS
+    jobs_parser = argparse.ArgumentParser(add_help=False)
+    jobs_parser.add_argument("-j", "--jobs", type=int, default=os.environ.get("UGIT_JOBS"))
+
     init_parser = commands.add_parser("init")
     init_parser.set_defaults(func=init)
 
@@ -30,12 +45,16 @@ def parse_args():
     hash_object_parser.add_argument("file")
 
     # give the object oid will print the file
+    # with --batch or --batch-check, print objects named on stdin (one per line) until it's closed
     cat_file_parser = commands.add_parser("cat_file")
     cat_file_parser.set_defaults(func=cat_file)
-    cat_file_parser.add_argument("oid", type=oid)
+    cat_file_parser.add_argument("oid", type=oid, nargs="?")
+    cat_file_batch_group = cat_file_parser.add_mutually_exclusive_group()
+    cat_file_batch_group.add_argument("--batch", action="store_true")
+    cat_file_batch_group.add_argument("--batch-check", action="store_true")
 
     # given a directory will hash, store and return the oid of the directory
-    write_tree_parser = commands.add_parser("write_tree")
+    write_tree_parser = commands.add_parser("write_tree", parents=[jobs_parser])
     write_tree_parser.set_defaults(func=write_tree)
 
     # given a tree oid will parse entries inside object and write oids inside tree to working directory
@@ -44,14 +63,16 @@ def parse_args():
     read_tree_parser.add_argument("tree", type=oid)
 
     # stores the current dirctory in object database and stores the oid of current directory and message in DB
-    commit_parser = commands.add_parser("commit")
+    commit_parser = commands.add_parser("commit", parents=[jobs_parser])
     commit_parser.set_defaults(func=commit)
-    commit_parser.add_argument("-m", "--message", required=True)
+    # the message is taken out of argv before argparse sees it, see _take_message
+    commit_parser.add_argument("-m", "--message")
 
     # log commit history from HEAD or provided oid
     log_parser = commands.add_parser("log")
     log_parser.set_defaults(func=log)
     log_parser.add_argument("oid", default="@", type=oid, nargs="?")
+    # log -- <path>... only shows commits that changed one of the paths
 
     # write that commit tree to current directory and set HEAD to point at that commit
     checout_parser = commands.add_parser("checkout")
@@ -78,7 +99,7 @@ def parse_args():
     # when you pass a tag or a name, it gets translated to oid in the parser
 
     # print the current branch
-    status_parser = commands.add_parser("status")
+    status_parser = commands.add_parser("status", parents=[jobs_parser])
     status_parser.set_defaults(func=status)
 
 
@@ -88,12 +109,12 @@ def parse_args():
     reset_parser.add_argument("commit", type=oid)
 
     # show diff of commit current commit and parent
-    show_parser = commands.add_parser("show")
+    show_parser = commands.add_parser("show", parents=[jobs_parser])
     show_parser.set_defaults(func=show)
     show_parser.add_argument("oid", default="@", type=oid, nargs="?")
 
     # diff the current working tree changes to a commit (not diff a commit to commit but a commit to current changes)
-    diff_parser = commands.add_parser("diff")
+    diff_parser = commands.add_parser("diff", parents=[jobs_parser])
     diff_parser.set_defaults(func=_diff)
     diff_parser.add_argument("commit", default="@", type=oid, nargs="?")
 
@@ -107,20 +128,109 @@ def parse_args():
     merge_base_parser.set_defaults(func=merge_base)
     merge_base_parser.add_argument("commit1", type=oid)
     merge_base_parser.add_argument("commit2", type=oid)
+    merge_base_parser.add_argument("commits", type=oid, nargs="*")
+    merge_base_parser.add_argument("-a", "--all", action="store_true")
+    merge_base_parser.add_argument("--octopus", action="store_true")
 
 
-    # fetchs a remote repository (on filesystem)
+    # fetchs a remote repository (on filesystem, or served with `serve` as unix:<socket> or stdio:<command>)
     fetch_parser = commands.add_parser("fetch")
     fetch_parser.set_defaults(func=fetch)
     fetch_parser.add_argument("remote")
 
-    # push local commits and objects to remote repository (on filesystem)
+    # push local commits and objects to remote repository (on filesystem, or served with `serve`)
     push_parser = commands.add_parser("push")
     push_parser.set_defaults(func=push)
     push_parser.add_argument("remote")
     push_parser.add_argument("branch")
 
-    return parser.parse_args()
+    # serve fetch and push for this repository on a Unix socket, or to one client on stdin/stdout
+    serve_parser = commands.add_parser("serve")
+    serve_parser.set_defaults(func=serve)
+    serve_group = serve_parser.add_mutually_exclusive_group()
+    serve_group.add_argument("--socket")
+    serve_group.add_argument("--stdio", action="store_true")
+    serve_parser.add_argument("repo", nargs="?", default=".")
+
+    # watch the working tree with inotify so status only looks at changed paths, until --stop
+    fsmonitor_parser = commands.add_parser("fsmonitor")
+    fsmonitor_parser.set_defaults(func=_fsmonitor)
+    fsmonitor_group = fsmonitor_parser.add_mutually_exclusive_group()
+    fsmonitor_group.add_argument("--detach", action="store_true")
+    fsmonitor_group.add_argument("--stop", action="store_true")
+
+    # move all loose objects into a pack, with --all repack every object into a single pack
+    repack_parser = commands.add_parser("repack")
+    repack_parser.set_defaults(func=repack)
+    repack_parser.add_argument("-a", "--all", action="store_true")
+
+    # delete unreachable loose objects older than the grace period (in seconds)
+    gc_parser = commands.add_parser("gc")
+    gc_parser.set_defaults(func=gc)
+    gc_parser.add_argument("--grace-period", type=int, default=base.GC_GRACE_PERIOD)
+
+    # move loose refs into the packed-refs file
+    pack_refs_parser = commands.add_parser("pack-refs")
+    pack_refs_parser.set_defaults(func=pack_refs)
+
+    # write the commit-graph file for all commits reachable from refs
+    commit_graph_parser = commands.add_parser("commit-graph")
+    commit_graph_parser.set_defaults(func=commit_graph)
+    commit_graph_parser.add_argument("action", choices=["write"])
+
+    argv = sys.argv[1:]
+    command = _command_name(argv)
+    # a commit message can be anything, argparse would take "--" or "-x" for an option (and
+    # drops "--" even from "--message=--")
+    message = None
+    if command == "commit":
+        argv, message = _take_message(argv, commit_parser)
+    # for log, everything after `--` is a list of paths, which argparse can't tell apart from an
+    # optional oid. other commands leave `--` to argparse
+    paths = []
+    if command == "log" and "--" in argv:
+        argv, paths = argv[:argv.index("--")], argv[argv.index("--") + 1:]
+    args = parser.parse_args(argv)
+    args.paths = paths
+    if command == "commit":
+        if message is None:
+            commit_parser.error("the following arguments are required: -m/--message")
+        args.message = message
+    return args
+
+
+# the subcommand is the first argument that isn't a top level option or the value of one
+def _command_name(argv):
+    args = iter(argv)
+    for arg in args:
+        if arg == "--trace-json":
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+    return None
+
+
+# remove `-m <message>`, `-m<message>` and `--message[=]<message>` from argv
+# return the other arguments and the message (the last one given), or None if there's none
+def _take_message(argv, parser):
+    out = []
+    message = None
+    args = iter(argv)
+    for arg in args:
+        if arg == "--":
+            out.append(arg)
+            out.extend(args)
+        elif arg in ("-m", "--message"):
+            message = next(args, None)
+            if message is None:
+                parser.error("argument -m/--message: expected one argument")
+        elif arg.startswith("--message="):
+            message = arg[len("--message="):]
+        elif arg.startswith("-m"):
+            message = arg[2:]
+        else:
+            out.append(arg)
+    return out, message
 
 
 def init(args):
@@ -130,25 +240,67 @@ def init(args):
 
 def hash_object(args):
     with open(args.file, "rb") as f:
-        print(data.hash_object(f.read()))
+        print(data.hash_object_stream(f))
 
 def cat_file(args):
+    if args.batch or args.batch_check:
+        _cat_file_batch(args.batch)
+        return
+    assert args.oid, "cat_file needs an object (or --batch / --batch-check)"
     sys.stdout.flush()
-    sys.stdout.buffer.write(data.get_object(args.oid, expected=None))
+    for chunk in data.iter_object(args.oid, expected=None):
+        sys.stdout.buffer.write(chunk)
+
+
+# for each name read from stdin write "<oid> <type> <size>\n", followed by the content and a
+# newline with --batch, or "<name> missing\n". every record is flushed as soon as it's written so
+# a tool can keep the process open and ask one object at a time. pack handles and object caches
+# stay loaded across requests, the refs a name could stand for are read again if it isn't a full oid
+def _cat_file_batch(with_content):
+    out = sys.stdout.buffer
+    for line in sys.stdin:
+        name = line.strip()
+        if not name:
+            continue
+        # refs may have moved since the last request, full oids don't need them
+        if len(name) != 40:
+            data.refresh_refs(base.ref_candidates(name))
+        try:
+            oid = base.get_oid(name)
+        except AssertionError:
+            oid = None
+        # the repository might have been repacked since the packs were loaded
+        if oid and not data.object_exist(oid):
+            data.reload_packs()
+        if not oid or not data.object_exist(oid):
+            out.write(f"{name} missing\n".encode())
+            out.flush()
+            continue
+
+        _type, size = data.get_object_info(oid)
+        out.write(f"{oid} {_type} {size}\n".encode())
+        if with_content:
+            if size <= data.MAX_CACHED_OBJECT:
+                out.write(data.get_object(oid, expected=None))
+            else:
+                for chunk in data.iter_object(oid, expected=None):
+                    out.write(chunk)
+            out.write(b"\n")
+        out.flush()
 
 def write_tree(args):
-    print("current Tree: ", base.write_tree())
+    print("current Tree: ", base.write_tree(args.jobs))
 
 def read_tree(args):
     base.read_tree(args.tree)
 
 def commit(args):
-    print("commit: ", base.commit(args.message))
+    print("commit: ", base.commit(args.message, args.jobs))
 
 
 def _print_commit(oid, commit, refs=None):
     refs_str = f' ({", ".join (refs)})' if refs else ""
-    print(f"commit {oid} {refs_str})")
+    print(f"commit {data.abbreviate(oid)} {refs_str})")
     print(textwrap.indent(commit.msg, "     "))
     print()
 
@@ -159,7 +311,11 @@ def log(args):
     for refname, ref in data.iter_refs():
         refs.setdefault(ref.value, []).append(refname)
 
+    paths = [os.path.normpath(path).strip("/") for path in args.paths]
+    assert all(path != "." and not path.startswith("..") for path in paths), "Paths must be inside the repository"
     for oid in base.iter_commits_and_parents({args.oid}):
+        if paths and not base.commit_changes_paths(oid, paths):
+            continue
         commit = base.get_commit(oid)
         _print_commit(oid, commit, refs.get(oid))
 
@@ -179,7 +335,7 @@ def branch(args):
             print (f"{prefix} {branch}")
     else:
         base.create_branch(args.name, args.start_point)
-        print(f"Branch {args.name} created at {args.start_point[:10]}")
+        print(f"Branch {args.name} created at {data.abbreviate(args.start_point)}")
 
 
 def status(args):
@@ -188,17 +344,16 @@ def status(args):
     if branch:
         print(f"On branch {branch}")
     else:
-        print(f"HEAD detached at {HEAD[:10]}")
+        print(f"HEAD detached at {data.abbreviate(HEAD)}")
 
     MERGE_HEAD = data.get_ref("MERGE_HEAD").value
     if MERGE_HEAD:
-        print (f"Merging with {MERGE_HEAD[:10]}")
+        print (f"Merging with {data.abbreviate(MERGE_HEAD)}")
 
     print("\n Changes to be commited:\n")
     HEAD_tree = HEAD and base.get_commit(HEAD).tree
-    for path, action in diff.iter_changed_files(
-                                            base.get_tree(HEAD_tree),
-                                            base.get_working_tree()):
+    changes = base.iter_tree_changes(HEAD_tree, base.write_tree(args.jobs))
+    for path, action in diff.iter_changed_files(changes):
         print (f"{action:>12}: {path}")
 
 
@@ -215,29 +370,37 @@ def show(args):
         parent_tree = base.get_commit(commit.parents[0]).tree
 
     _print_commit(args.oid, commit)
-    result = diff.diff_trees(
-        base.get_tree(parent_tree),
-        base.get_tree(commit.tree)
-    )
     sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    diff.diff_trees(
+        base.iter_tree_changes(parent_tree, commit.tree),
+        sys.stdout.buffer,
+        args.jobs
+    )
 
 
 def _diff(args):
     tree = args.commit and base.get_commit(args.commit).tree
 
     # diff tree with args.commit.oid to current working tree
-    result = diff.diff_trees(base.get_tree(tree), base.get_working_tree())
     sys.stdout.flush()
-    sys.stdout.buffer.write(result)
+    changes = base.iter_tree_changes(tree, base.write_tree(args.jobs))
+    diff.diff_trees(changes, sys.stdout.buffer, args.jobs)
 
 def merge(args):
     base.merge(args.commit)
 
 
 def merge_base(args):
-    common_parent = base.get_merge_base(args.commit1, args.commit2)
-    print(f"First common Parent: {common_parent}")
+    if args.octopus:
+        bases = base.get_octopus_merge_bases([args.commit1, args.commit2, *args.commits])
+    else:
+        bases = base.get_merge_bases(args.commit1, [args.commit2, *args.commits])
+
+    if not args.all:
+        print(f"First common Parent: {bases[0] if bases else None}")
+        return
+    for oid in bases:
+        print(oid)
 
 # Do `git fetch <path_to_remote>` to fetch the refs and missing DB objects
 # To test do `for file in $(ls .ugit/objects/); do cat .ugit/objects/$file; done | less`
@@ -250,6 +413,53 @@ def push(args):
     remote.push(args.remote, f"refs/heads/{args.branch}")
 
 
+def serve(args):
+    with data.change_git_dir(args.repo):
+        if args.stdio:
+            server.serve_stdio()
+        else:
+            server.serve_socket(args.socket or f"{data.GIT_DIR}/serve.sock")
+
+
+def _fsmonitor(args):
+    if args.stop:
+        fsmonitor.stop()
+        return
+    # the daemon goes on in a child process, detached from the terminal
+    if args.detach:
+        if os.fork():
+            return
+        os.setsid()
+        with open(os.devnull, "r+") as devnull:
+            for stream in (sys.stdin, sys.stdout, sys.stderr):
+                os.dup2(devnull.fileno(), stream.fileno())
+    fsmonitor.run()
+
+
+def repack(args):
+    path, count = data.repack(args.all)
+    if not path:
+        print("Nothing to repack")
+        return
+    print(f"Packed {count} objects into {path}")
+
+
+def gc(args):
+    result = base.gc(args.grace_period)
+    print(f"Marked {result.reachable} reachable objects in {result.timings['mark']:.3f}s")
+    print(f"Pruned {result.pruned} unreachable objects, reclaimed {result.reclaimed} bytes "
+          f"in {result.timings['prune']:.3f}s")
+
+
+def pack_refs(args):
+    print(f"Packed {data.pack_refs()} refs")
+
+
+def commit_graph(args):
+    count = base.write_commit_graph()
+    print(f"Wrote commit-graph with {count} commits")
+
+
 # write all refs and the commit a ref points to, then write history of commits and uses graphiz to link them
 def k(args):
     oids = set()
@@ -263,7 +473,7 @@ def k(args):
 
     for oid in base.iter_commits_and_parents(oids):
         commit = base.get_commit(oid)
-        dot += f'"{oid}" [shape=box style=filled label="{oid[:10]}"]\n'
+        dot += f'"{oid}" [shape=box style=filled label="{data.abbreviate(oid)}"]\n'
         for parent in commit.parents:
             dot += f'"{oid}" -> "{parent}"\n'
     dot += '}'
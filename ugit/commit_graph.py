@@ -0,0 +1,334 @@
+import os
+import mmap
+import struct
+import hashlib
+import itertools
+from collections import namedtuple
+from . import data
+
+
+# The commit-graph file stores the tree, parents and generation number of commits
+# so history can be walked without opening and parsing commit objects
+#
+# MAGIC | version, count | fanout[256] | oid[count] (20 bytes each) | record[count] | extra edges
+#
+# version 2 adds the number of extra edges to the header and the changed-path Bloom filters
+# (see bloom.py) after the extra edges: the end offset of each commit's filter, then all filters
+#
+# MAGIC | version, count, edge count | ... | extra edges | filter end[count] | filter data
+#
+# record: tree oid (20 bytes), first parent, second parent, generation
+# parents are positions in the oid table, NO_PARENT if there is none.
+# if a commit has more than 2 parents, the second parent is EXTRA_EDGES | i, where i is the index
+# of its remaining parents in the extra edges list. the last one of them has LAST_EDGE set
+#
+# `ugit commit-graph write` writes every commit in the commit-graph file. commits made after it
+# go into small incremental layers in commit-graphs/, listed bottom up in commit-graphs/chain.
+# positions in a layer continue after the commits of the layers below it, so a parent position can
+# point into any lower layer. a new layer absorbs the layers on top of the chain that are less than
+# twice its size, which keeps the chain short without ever rewriting the base file on commit
+MAGIC = b"UCGF"
+VERSION = 2
+NO_PARENT = 0x70000000
+EXTRA_EDGES = 0x80000000
+LAST_EDGE = 0x80000000
+# a new layer merges the top layer of the chain while it has more than 1 / LAYER_SIZE_FACTOR of its commits
+LAYER_SIZE_FACTOR = 2
+
+_HEADER = struct.Struct(">II")
+_EDGE_COUNT = struct.Struct(">I")
+_FANOUT = struct.Struct(">256I")
+_RECORD = struct.Struct(">20sIII")
+_EDGE = struct.Struct(">I")
+_BLOOM_END = struct.Struct(">I")
+
+# base_count is the number of commits in the layers below, where the positions of this one start
+Graph = namedtuple(
+    "Graph",
+    ["path", "mm", "fanout", "count", "oids_start", "records_start", "edges_start", "blooms_start", "base_count"],
+)
+Entry = namedtuple("Entry", ["tree", "parents", "generation"])
+
+# loaded layers for each GIT_DIR (the base file first), empty if there is no graph
+_graphs = {}
+
+
+def _path():
+    return f"{data.GIT_DIR}/commit-graph"
+
+
+def _layers_dir():
+    return f"{data.GIT_DIR}/commit-graphs"
+
+
+def _chain_path():
+    return f"{_layers_dir()}/chain"
+
+
+def exists():
+    return os.path.isfile(_path())
+
+
+def load():
+    path = _path()
+    if path not in _graphs:
+        layers = []
+        if os.path.isfile(path):
+            layers.append(_open(path, 0))
+        for name in _read_chain():
+            layers.append(_open(f"{_layers_dir()}/{name}", _total(layers)))
+        _graphs[path] = layers
+    return _graphs[path]
+
+
+def _read_chain():
+    if not os.path.isfile(_chain_path()):
+        return []
+    with open(_chain_path()) as f:
+        return f.read().split()
+
+
+def _total(layers):
+    return layers[-1].base_count + layers[-1].count if layers else 0
+
+
+def _open(path, base_count):
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    assert mm[:len(MAGIC)] == MAGIC, f"Bad commit-graph {path}"
+    version, count = _HEADER.unpack_from(mm, len(MAGIC))
+    fanout_start = len(MAGIC) + _HEADER.size
+    blooms_start = None
+    if version >= 2:
+        edge_count, = _EDGE_COUNT.unpack_from(mm, fanout_start)
+        fanout_start += _EDGE_COUNT.size
+    fanout = _FANOUT.unpack_from(mm, fanout_start)
+    oids_start = fanout_start + _FANOUT.size
+    records_start = oids_start + count * 20
+    edges_start = records_start + count * _RECORD.size
+    if version >= 2:
+        blooms_start = edges_start + edge_count * _EDGE.size
+    return Graph(
+        path=path, mm=mm, fanout=fanout, count=count, oids_start=oids_start,
+        records_start=records_start, edges_start=edges_start, blooms_start=blooms_start,
+        base_count=base_count,
+    )
+
+
+# return the position of a commit in the layers or None, the most recent layers are searched first
+def _find(layers, oid):
+    key = bytes.fromhex(oid)
+    for graph in reversed(layers):
+        pos = _find_in_layer(graph, key)
+        if pos is not None:
+            return graph.base_count + pos
+    return None
+
+
+# return position of a commit in one layer (not counting the layers below) or None
+def _find_in_layer(graph, key):
+    lo = graph.fanout[key[0] - 1] if key[0] else 0
+    hi = graph.fanout[key[0]]
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = graph.oids_start + mid * 20
+        current = graph.mm[start:start + 20]
+        if current < key:
+            lo = mid + 1
+        elif current > key:
+            hi = mid
+        else:
+            return mid
+    return None
+
+
+# return the layer holding position pos and the position inside it
+def _layer_at(layers, pos):
+    for graph in reversed(layers):
+        if pos >= graph.base_count:
+            return graph, pos - graph.base_count
+    raise AssertionError(f"Bad commit-graph position {pos}")
+
+
+def _oid_at(layers, pos):
+    graph, pos = _layer_at(layers, pos)
+    start = graph.oids_start + pos * 20
+    return graph.mm[start:start + 20].hex()
+
+
+def _entry_at(layers, pos):
+    graph, local = _layer_at(layers, pos)
+    tree, p1, p2, generation = _RECORD.unpack_from(graph.mm, graph.records_start + local * _RECORD.size)
+    parents = []
+    if p1 != NO_PARENT:
+        parents.append(_oid_at(layers, p1))
+    if p2 & EXTRA_EDGES:
+        offset = graph.edges_start + (p2 & ~EXTRA_EDGES) * _EDGE.size
+        while True:
+            edge, = _EDGE.unpack_from(graph.mm, offset)
+            parents.append(_oid_at(layers, edge & ~LAST_EDGE))
+            if edge & LAST_EDGE:
+                break
+            offset += _EDGE.size
+    elif p2 != NO_PARENT:
+        parents.append(_oid_at(layers, p2))
+    return Entry(tree=tree.hex(), parents=parents, generation=generation)
+
+
+def contains(oid):
+    return _find(load(), oid) is not None
+
+
+# return Entry(tree, parents, generation) of a commit, None if it's not in the graph
+def get_entry(oid):
+    layers = load()
+    pos = _find(layers, oid)
+    if pos is None:
+        return None
+    return _entry_at(layers, pos)
+
+
+# return the changed-path Bloom filter of a commit, None if the graph doesn't have one for it
+def get_bloom(oid):
+    layers = load()
+    pos = _find(layers, oid)
+    if pos is None:
+        return None
+    return _bloom_at(layers, pos)
+
+
+def _bloom_at(layers, pos):
+    graph, pos = _layer_at(layers, pos)
+    if graph.blooms_start is None:
+        return None
+    data_start = graph.blooms_start + graph.count * _BLOOM_END.size
+    start = _BLOOM_END.unpack_from(graph.mm, graph.blooms_start + (pos - 1) * _BLOOM_END.size)[0] if pos else 0
+    end, = _BLOOM_END.unpack_from(graph.mm, graph.blooms_start + pos * _BLOOM_END.size)
+    return graph.mm[data_start + start:data_start + end]
+
+
+# yield oid, Entry for every commit in the graph
+def iter_entries():
+    layers = load()
+    for pos in range(_total(layers)):
+        yield _oid_at(layers, pos), _entry_at(layers, pos)
+
+
+# write a new graph file from a dict of oid -> (tree, parents) and a dict of oid -> Bloom filter
+# every parent must be in the dict too. the incremental layers are removed
+def write(commits, blooms):
+    oids = sorted(commits)
+    positions = {oid: pos for pos, oid in enumerate(oids)}
+    path = _path()
+    _write_layer(f"{path}.lock", oids, commits, blooms, positions.__getitem__, _compute_generations(commits))
+    os.replace(f"{path}.lock", path)
+
+    names = _read_chain()
+    if os.path.isfile(_chain_path()):
+        os.remove(_chain_path())
+    for name in names:
+        os.remove(f"{_layers_dir()}/{name}")
+    _graphs.pop(path, None)
+    return len(oids)
+
+
+# add commits (oid -> (tree, parents)) that aren't in the graph yet as a new layer on top of the
+# chain, their parents must be in commits or in the graph. only the layers merged into the new
+# one are read, return the number of commits in the new layer
+def append(commits, blooms):
+    layers = load()
+    commits, blooms = dict(commits), dict(blooms)
+    # the base file is never merged here, only `commit-graph write` rewrites it
+    merged = []
+    while len(layers) > 1 and len(commits) * LAYER_SIZE_FACTOR > layers[-1].count:
+        graph = layers[-1]
+        for pos in range(graph.base_count, graph.base_count + graph.count):
+            oid, entry = _oid_at(layers, pos), _entry_at(layers, pos)
+            commits[oid] = (entry.tree, entry.parents)
+            blooms[oid] = _bloom_at(layers, pos)
+        merged.append(graph)
+        layers = layers[:-1]
+
+    oids = sorted(commits)
+    base_count = _total(layers)
+    local = {oid: base_count + pos for pos, oid in enumerate(oids)}
+    # generations of the parents already in lower layers
+    generations = {}
+    for tree, parents in commits.values():
+        for parent in parents:
+            if parent not in commits and parent not in generations:
+                generations[parent] = _entry_at(layers, _find(layers, parent)).generation
+    generations = _compute_generations(commits, generations)
+
+    def position(oid):
+        pos = local.get(oid)
+        return pos if pos is not None else _find(layers, oid)
+
+    os.makedirs(_layers_dir(), exist_ok=True)
+    tmp = f"{_layers_dir()}/tmp-{os.getpid()}.graph"
+    _write_layer(tmp, oids, commits, blooms, position, generations)
+    with open(tmp, "rb") as f:
+        name = f"graph-{hashlib.sha1(f.read()).hexdigest()}.graph"
+    os.replace(tmp, f"{_layers_dir()}/{name}")
+
+    names = [os.path.basename(graph.path) for graph in layers if graph.path != _path()] + [name]
+    with open(f"{_chain_path()}.lock", "w") as f:
+        f.write("".join(f"{n}\n" for n in names))
+    os.replace(f"{_chain_path()}.lock", _chain_path())
+    for graph in merged:
+        os.remove(graph.path)
+    _graphs.pop(_path(), None)
+    return len(oids)
+
+
+# write the commits of oids (sorted) to path, position(oid) gives the position of a parent
+def _write_layer(path, oids, commits, blooms, position, generations):
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    records, edges = [], []
+    for oid in oids:
+        tree, parents = commits[oid]
+        parents = [position(parent) for parent in parents]
+        p1 = parents[0] if parents else NO_PARENT
+        if len(parents) > 2:
+            p2 = EXTRA_EDGES | len(edges)
+            edges.extend(parents[1:-1])
+            edges.append(LAST_EDGE | parents[-1])
+        else:
+            p2 = parents[1] if len(parents) == 2 else NO_PARENT
+        records.append(_RECORD.pack(bytes.fromhex(tree), p1, p2, generations[oid]))
+
+    bloom_ends = list(itertools.accumulate(len(blooms[oid]) for oid in oids))
+
+    with open(path, "wb") as out:
+        out.write(MAGIC + _HEADER.pack(VERSION, len(oids)) + _EDGE_COUNT.pack(len(edges)))
+        out.write(_FANOUT.pack(*fanout))
+        out.write(b"".join(bytes.fromhex(oid) for oid in oids))
+        out.write(b"".join(records))
+        out.write(b"".join(_EDGE.pack(edge) for edge in edges))
+        out.write(b"".join(_BLOOM_END.pack(end) for end in bloom_ends))
+        out.write(b"".join(blooms[oid] for oid in oids))
+
+
+# generation of a commit is 1 + the max generation of its parents (root commits are 1)
+# generations can hold the already known generations of parents that aren't in commits
+def _compute_generations(commits, generations=None):
+    generations = dict(generations or {})
+    for oid in commits:
+        stack = [oid]
+        while stack:
+            current = stack[-1]
+            if current in generations:
+                stack.pop()
+                continue
+            pending = [p for p in commits[current][1] if p not in generations]
+            if pending:
+                stack.extend(pending)
+                continue
+            generations[current] = 1 + max((generations[p] for p in commits[current][1]), default=0)
+            stack.pop()
+    return generations
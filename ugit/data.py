@@ -1,45 +1,509 @@
 import os
+import json
+import zlib
+import bisect
+import functools
+import itertools
 import hashlib
-import shutil
+import tempfile
+import threading
 from collections import namedtuple
 from contextlib import contextmanager
+from . import pack
+from . import cache
+from . import delta
+from . import trace
 
 
 # will be temp initalized in cli.main()
 GIT_DIR = None
-GIT_OBJECTS = ".ugit/objects"
+
+# opened packs for each objects directory, loaded on first use
+_packs = {}
 
 @contextmanager
 def change_git_dir(new_dir):
     global GIT_DIR
     old_dir = GIT_DIR
     GIT_DIR = f"{new_dir}/.ugit"
-    yield
-    GIT_DIR = old_dir
+    try:
+        yield
+    finally:
+        GIT_DIR = old_dir
 
 
 
 def init():
     if not os.path.isdir(GIT_DIR):
         os.makedirs(GIT_DIR)
-        os.makedirs(GIT_OBJECTS)
+        os.makedirs(f"{GIT_DIR}/objects")
+
+# load the index (stat cache of the working tree), yield it to caller and write it back if
+# the caller set index["dirty"]. index["mtime"] is the mtime of the index file itself,
+# used to detect racily clean entries
+@contextmanager
+def get_index():
+    index = {"entries": {}}
+    path = f"{GIT_DIR}/index"
+    if os.path.isfile(path):
+        with open(path) as f:
+            index = json.load(f)
+        index["mtime"] = os.stat(path).st_mtime_ns
+    index.setdefault("mtime", 0)
+
+    yield index
+
+    if index.pop("dirty", False):
+        index.pop("mtime", None)
+        with open(f"{path}.lock", "w") as f:
+            json.dump(index, f)
+            f.flush()
+            mtime = os.fstat(f.fileno()).st_mtime_ns
+            # a file modified in the same tick as the index can't be told apart from its entry by
+            # stat data, and once this index is written, its mtime no longer shows it. smudge the
+            # size of such entries so they get rehashed next time, whoever writes the index after
+            if _smudge_racy_entries(index["entries"], mtime):
+                f.seek(0)
+                f.truncate()
+                json.dump(index, f)
+        os.replace(f"{path}.lock", path)
+
+
+# return how many entries modified at or after mtime were marked as racy
+def _smudge_racy_entries(entries, mtime):
+    smudged = 0
+    for entry in entries.values():
+        if entry[1] >= mtime and entry[0] != -1:
+            entry[0] = -1
+            smudged += 1
+    return smudged
+
+
+# objects are stored zlib compressed, both as loose files and inside packs
+CHUNK_SIZE = 1 << 16
+
 
 def hash_object(data, _type="blob"):
-    data = _type.encode() + b"\x00" + data
-    oid = hashlib.sha1(data).hexdigest()
-    with open(f"{GIT_OBJECTS}/{oid}", "wb") as out:
-        out.write(data)
-        return oid
+    header = _type.encode() + b"\x00"
+    sha = hashlib.sha1(header)
+    sha.update(data)
+    oid = sha.hexdigest()
+    if not object_exist(oid):
+        compressor = zlib.compressobj()
+        _write_loose(oid, (compressor.compress(header), compressor.compress(data), compressor.flush()))
+        if trace.ENABLED:
+            trace.count("object.writes")
+            trace.count("object.write_bytes", len(data))
+    return oid
+
+
+# hash and store the content of a binary file object without loading it in memory
+def hash_object_stream(f, _type="blob"):
+    header = _type.encode() + b"\x00"
+    if f.seekable():
+        # hash first so we never compress an object we already have
+        start = f.tell()
+        sha = hashlib.sha1(header)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+        oid = sha.hexdigest()
+        if object_exist(oid):
+            return oid
+        f.seek(start)
+
+    # hash what is written as it's written, and name the object after that: the file may have
+    # changed since it was hashed above. drop the temp file if we have the object
+    sha = hashlib.sha1()
+    tmp = _write_temp(_iter_compressed(header, f, sha))
+    oid = sha.hexdigest()
+    if object_exist(oid):
+        os.remove(tmp)
+    else:
+        os.replace(tmp, f"{GIT_DIR}/objects/{oid}")
+        _add_loose_oid(oid)
+        if trace.ENABLED:
+            trace.count("object.writes")
+    return oid
+
+
+def _iter_compressed(header, f, sha=None):
+    compressor = zlib.compressobj()
+    if sha:
+        sha.update(header)
+    yield compressor.compress(header)
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+        if sha:
+            sha.update(chunk)
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+# write compressed chunks to a temp file and atomically rename it to the object path
+def _write_loose(oid, chunks):
+    os.replace(_write_temp(chunks), f"{GIT_DIR}/objects/{oid}")
+    _add_loose_oid(oid)
+
+
+def _add_loose_oid(oid):
+    objects_dir = f"{GIT_DIR}/objects"
+    with _loose_oids_lock:
+        loose = _loose_oids.get(objects_dir)
+        if loose is not None:
+            i = bisect.bisect_left(loose, oid)
+            if i == len(loose) or loose[i] != oid:
+                _loose_oids[objects_dir] = loose[:i] + [oid] + loose[i:]
+
+
+def _write_temp(chunks):
+    fd, tmp = tempfile.mkstemp(dir=f"{GIT_DIR}/objects", prefix="tmp_obj_")
+    with os.fdopen(fd, "wb") as out:
+        for chunk in chunks:
+            out.write(chunk)
+    # mkstemp creates files only readable by the owner
+    os.chmod(tmp, 0o644)
+    return tmp
+
+
+# recently read objects, as (type, content), bounded by the total size of their content
+objects_cache = cache.LRUCache("objects", int(os.environ.get("UGIT_OBJECT_CACHE_SIZE", 64 << 20)))
+# objects bigger than this are never cached
+MAX_CACHED_OBJECT = 1 << 20
+
 
 def get_object(oid, expected="blob"):
-    with open(f"{GIT_OBJECTS}/{oid}", "rb") as f:
-        obj = f.read()
+    cached = objects_cache.get(oid)
+    if cached:
+        _type, content = cached
+    else:
+        _type, content = _read_object(oid)
+        if len(content) <= MAX_CACHED_OBJECT:
+            objects_cache.put(oid, (_type, content), len(content))
+        if trace.ENABLED:
+            trace.count("object.reads")
+            trace.count("object.read_bytes", len(content))
+    _check_type(_type, expected)
+    return content
+
+
+# return (type, content) of an object, without going through objects_cache
+def _read_object(oid):
+    found = _find_in_packs(oid)
+    if found and pack.delta_base(*found):
+        return _resolve_delta(oid, *found)
+    return _split_object(zlib.decompress(_read_compressed(oid)))
+
+
+def _split_object(obj):
+    end = obj.index(b"\x00")
+    return obj[:end].decode(), obj[end + 1:]
 
-    _type, _, content = obj.partition(b"\x00")
-    _type = _type.decode()
+
+# objects recently used as delta bases (or rebuilt from deltas), as (type, content)
+# consecutive versions of a file usually form a chain, so keeping them avoids rebuilding it each time
+delta_base_cache = cache.LRUCache("delta_bases", int(os.environ.get("UGIT_DELTA_BASE_CACHE_SIZE", 32 << 20)))
+
+
+# rebuild the object oid stored as a delta at offset in p: follow bases until a full object
+# or a cached one is found, then apply the deltas back up the chain
+def _resolve_delta(oid, p, offset):
+    chain = []
+    while True:
+        base = pack.delta_base(p, offset)
+        if base is None:
+            _type, content = _split_object(zlib.decompress(b"".join(pack.iter_at(p, offset, CHUNK_SIZE))))
+            delta_base_cache.put(oid, (_type, content), len(content))
+            break
+        chain.append((oid, p, offset))
+        cached = delta_base_cache.get(base)
+        if cached:
+            _type, content = cached
+            break
+        found = _find_in_packs(base)
+        assert found, f"Missing delta base {base}"
+        oid, (p, offset) = base, found
+
+    for oid, p, offset in reversed(chain):
+        content = delta.apply_delta(content, pack.read_delta(p, offset))
+        delta_base_cache.put(oid, (_type, content), len(content))
+    return _type, content
+
+
+# yield the content of an object in chunks, for blobs too big to hold in memory
+def iter_object(oid, expected="blob"):
+    if trace.ENABLED:
+        trace.count("object.reads")
+    _type, chunks = _open_object(oid)
+    _check_type(_type, expected)
+    yield from chunks
+
+
+# return (type, size) of an object. small objects end up in objects_cache, so reading them next
+# is free, big ones are measured by decompressing them in chunks without holding them in memory
+def get_object_info(oid):
+    cached = objects_cache.get(oid)
+    if cached:
+        return cached[0], len(cached[1])
+    _type, chunks = _open_object(oid)
+    content, size = [], 0
+    for chunk in chunks:
+        size += len(chunk)
+        if size <= MAX_CACHED_OBJECT:
+            content.append(chunk)
+    if size <= MAX_CACHED_OBJECT:
+        objects_cache.put(oid, (_type, b"".join(content)), size)
+    return _type, size
+
+
+# return the type of an object and an iterator over its content in chunks
+def _open_object(oid):
+    chunks = _iter_decompressed(_iter_compressed_chunks(oid))
+    header = b""
+    for chunk in chunks:
+        header += chunk
+        if b"\x00" in header:
+            break
+    _type, _, rest = header.partition(b"\x00")
+    return _type.decode(), itertools.chain([rest] if rest else [], chunks)
+
+
+def _check_type(_type, expected):
     if expected is not None:
         assert _type == expected, f"Expected {expected}, got {_type}"
-    return content
+
+
+def _iter_decompressed(chunks):
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+        # limit output size so highly compressible data does not blow up in memory
+        while chunk:
+            yield decompressor.decompress(chunk, CHUNK_SIZE)
+            chunk = decompressor.unconsumed_tail
+    yield decompressor.flush()
+
+
+# return the compressed object from a pack or from a loose object file
+def _read_compressed(oid):
+    return b"".join(_iter_compressed_chunks(oid))
+
+
+def _iter_compressed_chunks(oid):
+    found = _find_in_packs(oid)
+    if not found and not os.path.isfile(f"{GIT_DIR}/objects/{oid}"):
+        # someone might have repacked since we loaded the packs
+        found = _find_in_packs(oid, reload=True)
+    if found and pack.delta_base(*found):
+        _type, content = _resolve_delta(oid, *found)
+        yield zlib.compress(_type.encode() + b"\x00" + content)
+        return
+    if found:
+        yield from pack.iter_at(*found, CHUNK_SIZE)
+        return
+
+    with open(f"{GIT_DIR}/objects/{oid}", "rb") as f:
+        chunk = f.read(CHUNK_SIZE)
+        if chunk and chunk[0] != 0x78:
+            # loose objects written before compression was added are stored raw
+            yield zlib.compress(chunk + f.read())
+            return
+        while chunk:
+            yield chunk
+            chunk = f.read(CHUNK_SIZE)
+
+
+def _find_in_packs(oid, reload=False):
+    for p in _get_packs(reload):
+        offset = pack.find_offset(p, oid)
+        if offset is not None:
+            return p, offset
+    return None
+
+
+def _get_packs(reload=False):
+    pack_dir = f"{GIT_DIR}/objects/pack"
+    if reload:
+        for p in _packs.pop(pack_dir, ()):
+            pack.close_pack(p)
+
+    if pack_dir not in _packs:
+        names = os.listdir(pack_dir) if os.path.isdir(pack_dir) else []
+        _packs[pack_dir] = [
+            pack.open_pack(f"{pack_dir}/{name}") for name in sorted(names) if name.endswith(".idx")
+        ]
+    return _packs[pack_dir]
+
+
+# yield oids of all objects stored as loose files
+def iter_loose_objects():
+    for name in os.listdir(f"{GIT_DIR}/objects"):
+        if len(name) == 40 and os.path.isfile(f"{GIT_DIR}/objects/{name}"):
+            yield name
+
+
+# shortest abbreviation printed for an oid, and shortest prefix accepted when resolving one
+MIN_ABBREV = 4
+
+# sorted oids of loose objects for each objects directory, listed once per process
+# objects can be written by several threads (status -j), so a list is never changed in place:
+# it's replaced by a new one under the lock, and readers keep searching the sorted one they got
+_loose_oids = {}
+_loose_oids_lock = threading.Lock()
+
+def _get_loose_oids():
+    objects_dir = f"{GIT_DIR}/objects"
+    with _loose_oids_lock:
+        if objects_dir not in _loose_oids:
+            _loose_oids[objects_dir] = sorted(iter_loose_objects())
+        return _loose_oids[objects_dir]
+
+
+# every sorted oid list to search: one per pack and the loose objects, as (length, oid_at(i), lower_bound(prefix))
+def _iter_oid_indexes():
+    for p in _get_packs():
+        yield p.count, functools.partial(pack.oid_at, p), functools.partial(pack.lower_bound, p)
+    loose = _get_loose_oids()
+    yield len(loose), loose.__getitem__, functools.partial(bisect.bisect_left, loose)
+
+
+# return all oids starting with prefix
+def resolve_prefix(prefix):
+    prefix = prefix.lower()
+    matches = set()
+    for length, oid_at, lower_bound in _iter_oid_indexes():
+        i = lower_bound(prefix)
+        while i < length and oid_at(i).startswith(prefix):
+            matches.add(oid_at(i))
+            i += 1
+    return sorted(matches)
+
+
+# shortest prefix of oid (at least MIN_ABBREV long) that no other object shares
+def abbreviate(oid):
+    length = MIN_ABBREV
+    for count, oid_at, lower_bound in _iter_oid_indexes():
+        # only the neighbours of oid in a sorted list can share a longer prefix with it
+        i = lower_bound(oid)
+        for neighbour in (i - 1, i + 1 if i < count and oid_at(i) == oid else i):
+            if 0 <= neighbour < count:
+                length = max(length, _common_prefix_length(oid, oid_at(neighbour)) + 1)
+    return oid[:length]
+
+
+def _common_prefix_length(a, b):
+    n = 0
+    while n < len(a) and n < len(b) and a[n] == b[n]:
+        n += 1
+    return n
+
+
+# move all loose objects (and with all_objects, every packed object too) into a single pack
+# return the pack path and number of objects packed
+def repack(all_objects=False):
+    loose = list(iter_loose_objects())
+    old_packs = list(_get_packs()) if all_objects else []
+    oids = set(loose)
+    for p in old_packs:
+        oids.update(pack.iter_oids(p))
+    if not oids:
+        return None, 0
+
+    path = pack.write_pack(f"{GIT_DIR}/objects/pack", _iter_deltified(oids))
+    for p in old_packs:
+        if p.name != path[:-len(".pack")]:
+            os.remove(f"{p.name}.idx")
+            os.remove(f"{p.name}.pack")
+    reload_packs()
+    for oid in loose:
+        os.remove(f"{GIT_DIR}/objects/{oid}")
+    _loose_oids.pop(f"{GIT_DIR}/objects", None)
+    return path, len(oids)
+
+
+# objects are deltified against the DELTA_WINDOW objects before them, once sorted so that
+# versions of the same file (same type and name, biggest first) end up next to each other
+DELTA_WINDOW = 10
+# longest chain of deltas to rebuild when reading an object
+DELTA_DEPTH = 50
+# objects smaller than this are not worth a delta
+MIN_DELTA_SIZE = 64
+# a base is only tried if its size is within this factor of the object's size
+DELTA_SIZE_RATIO = 2
+# objects with a NUL byte in their first BINARY_CHECK_SIZE bytes are binary, and those whose first
+# COMPRESS_SAMPLE_SIZE bytes don't compress below INCOMPRESSIBLE_RATIO of their size are
+# (likely) compressed or random data. neither is deltified or used as a base
+BINARY_CHECK_SIZE = 8000
+COMPRESS_SAMPLE_SIZE = 1 << 16
+INCOMPRESSIBLE_RATIO = 0.9
+
+
+# yield (oid, base, compressed) for pack.write_pack, storing objects as deltas when it pays off
+def _iter_deltified(oids):
+    names = {}
+    sizes = {}
+    for oid in oids:
+        _type, content = _read_object(oid)
+        sizes[oid] = (_type, len(content))
+        if _type == "tree":
+            for line in content.decode().splitlines():
+                _, child, name = line.split(" ", 2)
+                names.setdefault(child, name)
+
+    ordered = sorted(oids, key=lambda oid: (sizes[oid][0], names.get(oid, ""), -sizes[oid][1], oid))
+    window = []
+    for oid in ordered:
+        _type, content = _read_object(oid)
+        best = None
+        deltify = len(content) >= MIN_DELTA_SIZE and _is_delta_candidate(content)
+        if deltify:
+            for base, base_type, base_content, blocks, depth in window:
+                if base_type != _type or depth >= DELTA_DEPTH:
+                    continue
+                if len(base_content) * DELTA_SIZE_RATIO < len(content) or len(base_content) > len(content) * DELTA_SIZE_RATIO:
+                    continue
+                # a delta must be at most half the object, and smaller than the best one so far
+                max_size = len(best[1]) - 1 if best else len(content) // 2
+                d = delta.create_delta(base_content, blocks, content, max_size)
+                if d is not None:
+                    best = base, d, depth + 1
+
+        if best:
+            base, d, depth = best
+            yield oid, base, zlib.compress(d)
+        else:
+            depth = 0
+            yield oid, None, zlib.compress(_type.encode() + b"\x00" + content)
+
+        if not deltify:
+            continue
+        window.append((oid, _type, content, delta.index(content), depth))
+        if len(window) > DELTA_WINDOW:
+            window.pop(0)
+
+
+def _is_delta_candidate(content):
+    if b"\x00" in content[:BINARY_CHECK_SIZE]:
+        return False
+    sample = content[:COMPRESS_SAMPLE_SIZE]
+    return len(zlib.compress(sample, 1)) < len(sample) * INCOMPRESSIBLE_RATIO
+
+
+# remove loose objects that are not in keep and were last modified before expire (a timestamp),
+# along with temp files left by interrupted writes. return the number of objects and bytes removed
+def prune_loose_objects(keep, expire):
+    objects_dir = f"{GIT_DIR}/objects"
+    count = size = 0
+    for name in os.listdir(objects_dir):
+        path = f"{objects_dir}/{name}"
+        is_object = len(name) == 40 and os.path.isfile(path)
+        if not (is_object and name not in keep) and not name.startswith("tmp_obj_"):
+            continue
+        st = os.stat(path)
+        if st.st_mtime >= expire:
+            continue
+        os.remove(path)
+        count += is_object
+        size += st.st_size
+    _loose_oids.pop(objects_dir, None)
+    return count, size
 
 
 RefValue = namedtuple("RefValue", ["symbolic", "value"])
@@ -51,17 +515,21 @@ def get_ref(ref, deref=True):
 # delete a ref by removing the branch file that stores oid to commit (not removing object in DB)
 def delete_ref(ref, deref=True):
     ref = _get_ref_internal(ref, deref)[0]
-    os.remove(f"{GIT_DIR}/{ref}")
+    refs = _get_refs()
+    refs.pop(ref, None)
+    if os.path.isfile(f"{GIT_DIR}/{ref}"):
+        os.remove(f"{GIT_DIR}/{ref}")
+    packed = _read_packed_refs()
+    if ref in packed:
+        del packed[ref]
+        _write_packed_refs(packed)
 
 
 # return the ref (path to a branch) and its symbolic ref or oid (if deref=true) of a tag or a branch
 def _get_ref_internal(ref, deref=True):
-    rel_path = f"{GIT_DIR}/{ref}"
-    value = None
-    if os.path.isfile(rel_path):
-        with open(rel_path, "r") as f:
-            value = f.read().strip()
-
+    if trace.ENABLED:
+        trace.count("ref.lookups")
+    value = _get_refs().get(ref)
     symbolic = bool(value) and value.startswith("ref:")
     if symbolic:
         value = value.split(":", 1)[1].strip()
@@ -80,18 +548,62 @@ def update_ref(ref, value, deref=True):
     else:
         value = value.value
 
-    rel_path = f"{GIT_DIR}/{ref}"
-    os.makedirs(os.path.dirname(rel_path), exist_ok=True)
-    with open(rel_path, "w") as f:
+    with _lock_ref(ref) as f:
         f.write(value)
+    _get_refs()[ref] = value
+
+
+# move ref to new only if its value on disk is still old (None for a ref that doesn't exist)
+# the check and the write both happen while holding the ref's lock, so two processes moving
+# the same ref can't both succeed
+def update_ref_if(ref, old, new):
+    with _lock_ref(ref) as f:
+        current = _read_ref_from_disk(ref)
+        assert current == old, f"{ref} changed to {current}, expected {old}"
+        f.write(new)
+    _get_refs()[ref] = new
+
 
-# yields relative path to all files in refs dir
+# create <ref>.lock exclusively and yield it for writing the new value, which replaces the ref
+# when the block ends. if the block raises, the lock is removed and the ref is left as it was
+@contextmanager
+def _lock_ref(ref):
+    check_ref_name(ref)
+    path = f"{GIT_DIR}/{ref}"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        fd = os.open(f"{path}.lock", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        raise AssertionError(f"{ref} is being updated by another process ({path}.lock exists)")
+    try:
+        with os.fdopen(fd, "w") as f:
+            yield f
+        os.replace(f"{path}.lock", path)
+    except BaseException:
+        os.remove(f"{path}.lock")
+        raise
+
+
+# a ref name is a "/" separated path inside GIT_DIR, so it can't have empty, "." or ".."
+# components, and no component can end in ".lock" (those are the locks of other refs)
+def check_ref_name(ref):
+    assert _is_ref_name(ref), f"Bad ref name {ref!r}"
+
+
+def _is_ref_name(ref):
+    return all(part and part not in (".", "..") and not part.endswith(".lock") for part in ref.split("/"))
+
+
+def _read_ref_from_disk(ref):
+    if os.path.isfile(f"{GIT_DIR}/{ref}"):
+        with open(f"{GIT_DIR}/{ref}") as f:
+            return f.read().strip()
+    return _read_packed_refs().get(ref)
+
+# yields relative path to all refs
 def iter_refs(prefix="", deref=False):
     refs = ["HEAD", "MERGE_HEAD"]
-    for root, _, filenames in os.walk(f"{GIT_DIR}/refs/"):
-        # get relative path of root, relative to {GIT_DIR}
-        path = os.path.relpath(root, GIT_DIR)
-        refs.extend(f"{path}/{name}" for name in filenames)
+    refs.extend(sorted(name for name in _get_refs() if name.startswith("refs/")))
 
     for ref_name in refs:
         if not ref_name.startswith(prefix):
@@ -101,18 +613,144 @@ def iter_refs(prefix="", deref=False):
             yield ref_name, ref
 
 
-# check if an object file exist
+# table of every ref name to its raw value for each GIT_DIR, loaded once per process
+# packed refs are read first and loose ref files override them
+# it's not invalidated when another process moves a ref, long running callers call reload_refs()
+# before reading every ref (serve), or refresh_refs() with the few refs they're about to read
+# (cat_file --batch)
+_refs = {}
+# the content of packed-refs for each GIT_DIR as (stat key, refs), read again when the file changes
+_packed_refs = {}
+
+
+def reload_refs():
+    _refs.pop(GIT_DIR, None)
+
+
+# read refs (and the refs they point to) from disk again, without reloading the whole table
+def refresh_refs(names):
+    refs = _get_refs()
+    packed = _get_packed_refs()
+    pending = [name for name in names if _is_ref_name(name)]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            with open(f"{GIT_DIR}/{name}") as f:
+                value = f.read().strip()
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+            value = packed.get(name)
+        if value is None:
+            refs.pop(name, None)
+            continue
+        refs[name] = value
+        if value.startswith("ref:"):
+            pending.append(value.split(":", 1)[1].strip())
+
+
+def _get_refs():
+    if GIT_DIR not in _refs:
+        refs = dict(_get_packed_refs())
+        loose = ["HEAD", "MERGE_HEAD"]
+        for root, _, filenames in os.walk(f"{GIT_DIR}/refs/"):
+            # get relative path of root, relative to {GIT_DIR}
+            path = os.path.relpath(root, GIT_DIR)
+            loose.extend(f"{path}/{name}" for name in filenames if not name.endswith(".lock"))
+        files_read = 0
+        for ref_name in loose:
+            if os.path.isfile(f"{GIT_DIR}/{ref_name}"):
+                with open(f"{GIT_DIR}/{ref_name}", "r") as f:
+                    refs[ref_name] = f.read().strip()
+                files_read += 1
+        _refs[GIT_DIR] = refs
+        if trace.ENABLED:
+            trace.count("ref.table_loads")
+            trace.count("ref.file_reads", files_read)
+    return _refs[GIT_DIR]
+
+
+def _get_packed_refs():
+    try:
+        st = os.stat(f"{GIT_DIR}/packed-refs")
+        key = (st.st_size, st.st_mtime_ns, st.st_ino)
+    except FileNotFoundError:
+        key = None
+    cached = _packed_refs.get(GIT_DIR)
+    if cached is None or cached[0] != key:
+        cached = _packed_refs[GIT_DIR] = (key, _read_packed_refs() if key else {})
+    return cached[1]
+
+
+# packed-refs has one "<oid> <ref name>" line per ref, sorted by name
+def _read_packed_refs():
+    refs = {}
+    if os.path.isfile(f"{GIT_DIR}/packed-refs"):
+        with open(f"{GIT_DIR}/packed-refs", "r") as f:
+            for line in f:
+                oid, name = line.rstrip("\n").split(" ", 1)
+                refs[name] = oid
+    return refs
+
+
+def _write_packed_refs(refs):
+    path = f"{GIT_DIR}/packed-refs"
+    with open(f"{path}.lock", "w") as f:
+        f.writelines(f"{oid} {name}\n" for name, oid in sorted(refs.items()))
+    os.replace(f"{path}.lock", path)
+
+
+# move every loose ref under refs/ (except symbolic ones) into packed-refs, return how many were packed
+def pack_refs():
+    packed = _read_packed_refs()
+    loose = {
+        name: value for name, value in _get_refs().items()
+        if name.startswith("refs/") and not value.startswith("ref:")
+        and os.path.isfile(f"{GIT_DIR}/{name}")
+    }
+    packed.update(loose)
+    _write_packed_refs(packed)
+    for name in loose:
+        os.remove(f"{GIT_DIR}/{name}")
+        try:
+            os.removedirs(os.path.dirname(f"{GIT_DIR}/{name}"))
+        except OSError:
+            pass
+    os.makedirs(f"{GIT_DIR}/refs", exist_ok=True)
+    return len(loose)
+
+
+# check if an object exist in a pack or as a loose object file
 def object_exist(oid):
-    return os.path.isfile(f"{GIT_DIR}/objects/{oid}")
+    if os.path.isfile(f"{GIT_DIR}/objects/{oid}"):
+        return True
+    return any(pack.find_offset(p, oid) is not None for p in _get_packs())
 
-def fetch_object_if_missing(oid, remote_git_dir):
-    if object_exist(oid):
-        return
-    remote_git_dir += "/.ugit"
-    shutil.copy(f"{remote_git_dir}/objects/{oid}", f"{GIT_DIR}/objects/{oid}")
+# yield a pack stream of the objects oids, read from the repository at repo_path (or GIT_DIR)
+# objects are read as the stream is consumed, so the receiver can run in another GIT_DIR
+def iter_pack_stream(oids, repo_path=None):
+    def objects():
+        for oid in oids:
+            if repo_path is None:
+                obj = _read_compressed(oid)
+            else:
+                with change_git_dir(repo_path):
+                    obj = _read_compressed(oid)
+            yield obj
+
+    return pack.iter_pack(objects(), len(oids))
+
+
+# store an incoming pack stream (iterable of chunks) as a new pack, return the number of objects
+def receive_pack(chunks, progress=None):
+    path, count = pack.index_pack(pack.chunk_reader(chunks), f"{GIT_DIR}/objects/pack", progress, CHUNK_SIZE)
+    if path:
+        reload_packs()
+    return count
 
 
-# copy object by it's oid to remote repo
-def push_object(oid, remote_git_dir):
-    remote_git_dir += "/.ugit"
-    shutil.copy(f"{GIT_DIR}/objects/{oid}", f"{remote_git_dir}/objects/{oid}")
+# pick up packs added since they were last listed
+def reload_packs():
+    _get_packs(reload=True)
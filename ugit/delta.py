@@ -0,0 +1,144 @@
+# A delta rebuilds a target object from a base object. It starts with the sizes of the base and
+# the target (7 bits per byte, high bit set on every byte but the last) followed by instructions:
+#
+# copy:   0x80 | flags, then the non-zero bytes of offset (flags bits 0-3) and size (bits 4-6),
+#         least significant first. copies base[offset:offset + size]
+# insert: n (1-127) followed by n bytes to copy from the delta itself
+#
+# matches are found by indexing the base in BLOCK sized blocks and looking up block sized
+# windows of the target, then extending each hit both ways. after a miss the lookup moves
+# MISS_STEP bytes on: since it's coprime with BLOCK, content shifted by any amount relative to the
+# base still meets an indexed block within BLOCK * MISS_STEP bytes, and the backward extension
+# recovers the bytes skipped before it. only shorter matches can be missed
+BLOCK = 16
+MISS_STEP = BLOCK - 1
+MAX_INSERT = 0x7F
+MAX_COPY = 0xFFFFFF
+
+
+# map the content of each BLOCK aligned block of base to its offset
+def index(base):
+    blocks = {}
+    for i in range(0, len(base) - BLOCK + 1, BLOCK):
+        blocks.setdefault(base[i:i + BLOCK], i)
+    return blocks
+
+
+# return a delta from base (indexed by blocks) to target, or None if it would be bigger than max_size
+def create_delta(base, blocks, target, max_size):
+    out = bytearray(_encode_size(len(base)) + _encode_size(len(target)))
+    literal = 0
+    i = 0
+    while i + BLOCK <= len(target):
+        # give up early, the pending insert will cost at least its length
+        if len(out) + i - literal > max_size:
+            return None
+
+        start = blocks.get(target[i:i + BLOCK])
+        if start is None:
+            i += MISS_STEP
+            continue
+
+        length = BLOCK + _match_length(base, start + BLOCK, target, i + BLOCK)
+        # reclaim bytes before the hit that were going to be inserted
+        while start and i > literal and base[start - 1] == target[i - 1]:
+            start -= 1
+            i -= 1
+            length += 1
+
+        _insert(out, target[literal:i])
+        _copy(out, start, length)
+        i += length
+        literal = i
+
+    _insert(out, target[literal:])
+    if len(out) > max_size:
+        return None
+    return bytes(out)
+
+
+def apply_delta(base, delta):
+    base_size, pos = _decode_size(delta, 0)
+    size, pos = _decode_size(delta, pos)
+    assert base_size == len(base), "Delta base size mismatch"
+
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            offset = length = 0
+            for shift in range(4):
+                if op & (1 << shift):
+                    offset |= delta[pos] << (8 * shift)
+                    pos += 1
+            for shift in range(3):
+                if op & (0x10 << shift):
+                    length |= delta[pos] << (8 * shift)
+                    pos += 1
+            out += base[offset:offset + length]
+        else:
+            assert op, "Bad delta instruction"
+            out += delta[pos:pos + op]
+            pos += op
+
+    assert len(out) == size, "Delta result size mismatch"
+    return bytes(out)
+
+
+# number of equal bytes in a (from i) and b (from j), compared in shrinking steps
+def _match_length(a, i, b, j):
+    length = 0
+    for step in (4096, 256, 16, 1):
+        while i + length + step <= len(a) and j + length + step <= len(b) and \
+                a[i + length:i + length + step] == b[j + length:j + length + step]:
+            length += step
+    return length
+
+
+def _insert(out, data):
+    for i in range(0, len(data), MAX_INSERT):
+        chunk = data[i:i + MAX_INSERT]
+        out.append(len(chunk))
+        out += chunk
+
+
+def _copy(out, offset, length):
+    while length:
+        size = min(length, MAX_COPY)
+        op = 0x80
+        args = bytearray()
+        for shift in range(4):
+            byte = (offset >> (8 * shift)) & 0xFF
+            if byte:
+                op |= 1 << shift
+                args.append(byte)
+        for shift in range(3):
+            byte = (size >> (8 * shift)) & 0xFF
+            if byte:
+                op |= 0x10 << shift
+                args.append(byte)
+        out.append(op)
+        out += args
+        offset += size
+        length -= size
+
+
+def _encode_size(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(0x80 | (n & 0x7F))
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _decode_size(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return n, pos
@@ -1,7 +1,9 @@
-import subprocess
-from collections import defaultdict
-from tempfile import NamedTemporaryFile as Temp
+import os
+import bisect
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from . import data
+from . import trace
 
 
 # def x(*trees) is a function that accepts many arguments and put them in list
@@ -17,37 +19,268 @@ def compare_trees(*trees):
         yield (path, *oids)
 
 
-# takes 2 oids, if they don't match, we call diff_blog on the 2
-def diff_trees(t_from, t_to):
-    output = b""
-    for path, o_from, o_to in compare_trees(t_from, t_to):
-        if o_from != o_to:
-            output += diff_blob(o_from, o_to)
+# number of changed files from which diffs are computed by a pool of worker processes
+PARALLEL_THRESHOLD = 64
+CONTEXT = 3
+# size (in lines) from which inputs are split on unique lines before running Myers
+ANCHOR_THRESHOLD = 2000
+# GNU diff treats a file with a NUL byte in its first block as binary
+BINARY_CHECK_SIZE = 8000
+
+
+# takes (path, o_from, o_to) changes (from compare_trees or base.iter_tree_changes)
+# for every path where oids don't match write diff_blob of the 2 to out
+def diff_trees(changes, out, jobs=None):
+    changes = [
+        (o_from, o_to, path)
+        for path, o_from, o_to in changes
+        if o_from != o_to
+    ]
+    # counted here, diffs can run in worker processes
+    if trace.ENABLED:
+        trace.count("diff.blob_diffs", len(changes))
+    with trace.phase("diff_blobs"):
+        for output in _iter_diffs(changes, jobs):
+            out.write(output)
+
+
+# yield diff_blob of each change in order, using worker processes when there are many of them
+def _iter_diffs(changes, jobs):
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(changes) < PARALLEL_THRESHOLD:
+        for change in changes:
+            yield diff_blob(*change)
+        return
+
+    with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(data.GIT_DIR,)) as pool:
+        yield from pool.map(_diff_change, changes, chunksize=16)
+
 
-    return output
+def _init_worker(git_dir):
+    data.GIT_DIR = git_dir
 
 
+def _diff_change(change):
+    return diff_blob(*change)
+
+
+# unified diff (with C function headings) of 2 blobs, same output as `diff -u -p`
 def diff_blob(o_from, o_to, path="blob"):
-    with Temp() as f_from, Temp() as f_to:
-        for oid, f in ((o_from, f_from), (o_to, f_to)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-
-        with subprocess.Popen([
-            "diff", "--unified", "--show-c-function",
-            "--label", f"a/{path}", f_from.name,
-            "--label", f"b/{path}", f_to.name],
-            # "--label", f".ugit/objects/{o_from}", f_from.name, # also works but
-            # "--label", f".ugit/objects/{o_to}", f_to.name],
-            stdout=subprocess.PIPE
-        ) as proc:
-            output, _ = proc.communicate ()
-    return output
-
-
-def iter_changed_files(t_from, t_to):
-    for path, o_from, o_to in compare_trees(t_from, t_to):
+    a = data.get_object(o_from) if o_from else b""
+    b = data.get_object(o_to) if o_to else b""
+    label_a, label_b = f"a/{path}", f"b/{path}"
+    if a == b:
+        return b""
+    if b"\x00" in a[:BINARY_CHECK_SIZE] or b"\x00" in b[:BINARY_CHECK_SIZE]:
+        return f"Binary files {label_a} and {label_b} differ\n".encode()
+
+    lines_a, lines_b = a.splitlines(keepends=True), b.splitlines(keepends=True)
+    output = [f"--- {label_a}\n+++ {label_b}\n".encode()]
+    last_function = [0, None]
+    for hunk in _group_hunks(_get_opcodes(lines_a, lines_b), len(lines_a), len(lines_b)):
+        output.append(_format_hunk(hunk, lines_a, lines_b, last_function))
+    return b"".join(output)
+
+
+# turn matched line pairs into (tag, i1, i2, j1, j2) opcodes, tag is "equal" or "replace"
+# (a "replace" with an empty side is a pure insert or delete)
+def _get_opcodes(lines_a, lines_b):
+    # compare small ints instead of lines
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in lines_a]
+    b = [ids.setdefault(line, len(ids)) for line in lines_b]
+    matches = []
+    _lcs(a, 0, len(a), b, 0, len(b), matches)
+    matches.append((len(a), len(b)))
+
+    opcodes = []
+    i = j = 0
+    for x, y in matches:
+        if i < x or j < y:
+            opcodes.append(("replace", i, x, j, y))
+        if x < len(a):
+            if opcodes and opcodes[-1][0] == "equal":
+                _, i1, _, j1, _ = opcodes.pop()
+                opcodes.append(("equal", i1, x + 1, j1, y + 1))
+            else:
+                opcodes.append(("equal", x, x + 1, y, y + 1))
+        i, j = x + 1, y + 1
+    return opcodes
+
+
+# Myers' linear space diff: append matching (i, j) line pairs of a[alo:ahi] and b[blo:bhi] to out
+def _lcs(a, alo, ahi, b, blo, bhi, out):
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        out.append((alo, blo))
+        alo, blo = alo + 1, blo + 1
+    tail = []
+    while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+        ahi, bhi = ahi - 1, bhi - 1
+        tail.append((ahi, bhi))
+
+    if alo < ahi and blo < bhi and (ahi - alo) + (bhi - blo) > ANCHOR_THRESHOLD:
+        # Myers is O((N+M)D), big inputs are first split on lines unique to both sides
+        anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+        if anchors:
+            for x, y in anchors:
+                _lcs(a, alo, x, b, blo, y, out)
+                out.append((x, y))
+                alo, blo = x + 1, y + 1
+            _lcs(a, alo, ahi, b, blo, bhi, out)
+            out.extend(reversed(tail))
+            return
+
+    if alo < ahi and blo < bhi:
+        x, y, u, v = _middle_snake(a, alo, ahi, b, blo, bhi)
+        _lcs(a, alo, x, b, blo, y, out)
+        out.extend((x + k, y + k) for k in range(u - x))
+        _lcs(a, u, ahi, b, v, bhi, out)
+    out.extend(reversed(tail))
+
+
+# patience diff anchors: the longest increasing sequence of lines that appear exactly once on both sides
+def _unique_anchors(a, alo, ahi, b, blo, bhi):
+    counts = defaultdict(lambda: [0, 0, 0])
+    for i in range(alo, ahi):
+        entry = counts[a[i]]
+        entry[0] += 1
+        entry[2] = i
+    for j in range(blo, bhi):
+        counts[b[j]][1] += 1
+    pairs = [(counts[b[j]][2], j) for j in range(blo, bhi) if counts[b[j]][:2] == [1, 1]]
+
+    # patience sorting on positions in a, with back pointers to rebuild the sequence
+    tops, piles, back = [], [], {}
+    for i, j in pairs:
+        n = bisect.bisect_left(tops, i)
+        back[(i, j)] = piles[n - 1] if n else None
+        if n == len(tops):
+            tops.append(i)
+            piles.append((i, j))
+        else:
+            tops[n] = i
+            piles[n] = (i, j)
+
+    anchors = []
+    pair = piles[-1] if piles else None
+    while pair:
+        anchors.append(pair)
+        pair = back[pair]
+    return anchors[::-1]
+
+
+# find the middle snake of the shortest edit script, searching forward and backward at once
+# returns its start and end as (x, y, u, v)
+def _middle_snake(a, alo, ahi, b, blo, bhi):
+    n, m = ahi - alo, bhi - blo
+    delta = n - m
+    odd = delta & 1
+    offset = n + m + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+
+    for d in range((n + m + 1) // 2 + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x, y = x + 1, y + 1
+            forward[offset + k] = x
+            if odd and -(d - 1) <= delta - k <= d - 1 and x + backward[offset + delta - k] >= n:
+                return alo + x0, blo + y0, alo + x, blo + y
+
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            x0, y0 = x, y
+            while x < n and y < m and a[ahi - 1 - x] == b[bhi - 1 - y]:
+                x, y = x + 1, y + 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and x + forward[offset + delta - k] >= n:
+                return ahi - x, bhi - y, ahi - x0, bhi - y0
+
+    assert False, "No middle snake found"
+
+
+# group opcodes into hunks with CONTEXT equal lines around changes, like difflib.get_grouped_opcodes
+def _group_hunks(opcodes, len_a, len_b):
+    hunk = []
+    for n, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+        if tag == "equal":
+            if not hunk:
+                continue
+            if i2 - i1 > 2 * CONTEXT or i2 == len_a:
+                hunk.append((tag, i1, min(i2, i1 + CONTEXT), j1, min(j2, j1 + CONTEXT)))
+                yield hunk
+                hunk = []
+            else:
+                hunk.append((tag, i1, i2, j1, j2))
+            continue
+
+        if not hunk and n > 0:
+            _, pi1, pi2, pj1, pj2 = opcodes[n - 1]
+            start = max(pi1, pi2 - CONTEXT)
+            hunk.append(("equal", start, pi2, pj2 - (pi2 - start), pj2))
+        hunk.append((tag, i1, i2, j1, j2))
+    if hunk:
+        yield hunk
+
+
+def _format_hunk(hunk, lines_a, lines_b, last_function):
+    i1, i2 = hunk[0][1], hunk[-1][2]
+    j1, j2 = hunk[0][3], hunk[-1][4]
+    header = f"@@ -{_format_range(i1, i2)} +{_format_range(j1, j2)} @@"
+    function = _find_function(lines_a, i1, last_function)
+    if function:
+        header += f" {function}"
+
+    output = [header.encode() + b"\n"]
+    for tag, i1, i2, j1, j2 in hunk:
+        if tag == "equal":
+            output.extend(_format_lines(b" ", lines_a[i1:i2]))
+            continue
+        output.extend(_format_lines(b"-", lines_a[i1:i2]))
+        output.extend(_format_lines(b"+", lines_b[j1:j2]))
+    return b"".join(output)
+
+
+def _format_range(start, end):
+    length = end - start
+    if length == 1:
+        return f"{start + 1}"
+    # an empty range starts at the line before it
+    return f"{start + 1 if length else start},{length}"
+
+
+def _format_lines(prefix, lines):
+    for line in lines:
+        yield prefix + line
+        if not line.endswith(b"\n"):
+            yield b"\n\\ No newline at end of file\n"
+
+
+# the closest line before a hunk that starts like a function definition (a letter, `_` or `$`)
+# hunks come in order, so each call only scans the lines after where the previous one stopped
+def _find_function(lines, start, last):
+    searched, match = last
+    for i in range(start - 1, searched - 1, -1):
+        line = lines[i]
+        if line[:1].isalpha() or line[:1] in (b"_", b"$"):
+            match = line.rstrip(b"\n")[:40].rstrip().decode(errors="replace")
+            break
+    last[:] = [start, match]
+    return match
+
+
+def iter_changed_files(changes):
+    for path, o_from, o_to in changes:
         if o_from != o_to:
             action = (
                 "new file" if not o_from else
@@ -57,32 +290,109 @@ def iter_changed_files(t_from, t_to):
             yield path, action
 
 
-# given 2 trees, will go over each file from both trees, merge and store in a dict
+# a path that could not be merged cleanly, kind is "content" or "modify/delete"
+Conflict = namedtuple("Conflict", ["path", "kind", "hunks"])
+# a conflicting region: line where its markers start in the merged file
+# and the (start, end) line ranges it covers in each version
+ConflictHunk = namedtuple("ConflictHunk", ["start", "base", "HEAD", "other"])
+
+
+# given 3 trees, resolve each path and store its oid in a dict, return it with a list of conflicts
+# paths where base matches a side (or both sides agree) are resolved by comparing oids,
+# only paths changed on both sides get merged line by line
 def merge_trees(t_base, t_HEAD, t_other):
     tree = dict()
+    conflicts = []
     for path, o_base, o_HEAD, o_other in compare_trees(t_base, t_HEAD, t_other):
-        tree[path] = merge_blobs(o_base, o_HEAD, o_other)
+        if o_HEAD == o_other or o_base == o_other:
+            oid = o_HEAD
+        elif o_base == o_HEAD:
+            oid = o_other
+        elif not o_HEAD or not o_other:
+            # one side deleted the file and the other changed it, keep the changes
+            oid = o_HEAD or o_other
+            conflicts.append(Conflict(path=path, kind="modify/delete", hunks=[]))
+        else:
+            content, hunks = merge_blobs(o_base, o_HEAD, o_other)
+            oid = data.hash_object(content)
+            if hunks:
+                conflicts.append(Conflict(path=path, kind="content", hunks=hunks))
+
+        if oid:
+            tree[path] = oid
 
-    return tree
+    return tree, conflicts
 
 
-# given 2 file oids, will read files into temp files merge and return merged content
+# given 3 file oids, merge the changes of both sides to base like `diff3 -m`
+# return merged content and the list of conflicting hunks
 def merge_blobs(o_base, o_HEAD, o_other):
-    with Temp() as f_base, Temp() as f_HEAD, Temp() as f_other:
-        # write blobs to temp files
-        for oid, f in ((o_base, f_base), (o_HEAD, f_HEAD), (o_other, f_other)):
-            if oid:
-                f.write(data.get_object(oid))
-                f.flush()
-
-        with subprocess.Popen ([
-            "diff3", "-m",
-            "-L", "HEAD", f_HEAD.name,
-            "-L", "BASE", f_base.name,
-            "-L", "MERGE_HEAD", f_other.name,
-        ], stdout=subprocess.PIPE) as proc:
-            output, _ = proc.communicate ()
-            assert proc.returncode in (0, 1)
-
-        return output
+    if trace.ENABLED:
+        trace.count("merge.blob_merges")
+    base, HEAD, other = (
+        data.get_object(oid).splitlines(keepends=True) if oid else []
+        for oid in (o_base, o_HEAD, o_other)
+    )
+    output, hunks = [], []
+    for chunk_base, chunk_HEAD, chunk_other in _iter_merge_chunks(base, HEAD, other):
+        lines_base, lines_HEAD, lines_other = (
+            version[start:end] for version, (start, end) in
+            ((base, chunk_base), (HEAD, chunk_HEAD), (other, chunk_other))
+        )
+        if lines_HEAD == lines_other or lines_base == lines_other:
+            output.extend(lines_HEAD)
+        elif lines_base == lines_HEAD:
+            output.extend(lines_other)
+        else:
+            hunks.append(ConflictHunk(start=len(output) + 1, base=chunk_base, HEAD=chunk_HEAD, other=chunk_other))
+            output.append(b"<<<<<<< HEAD\n")
+            output.extend(_terminated(lines_HEAD))
+            output.append(b"||||||| BASE\n")
+            output.extend(_terminated(lines_base))
+            output.append(b"=======\n")
+            output.extend(_terminated(lines_other))
+            output.append(b">>>>>>> MERGE_HEAD\n")
+
+    return b"".join(output), hunks
+
+
+# split 3 versions into chunks of (start, end) line ranges, one for each version
+# chunks alternate between stable ones (lines unchanged on both sides) and ones changed on either side
+def _iter_merge_chunks(base, HEAD, other):
+    matches_HEAD = _get_matches(base, HEAD)
+    matches_other = _get_matches(base, other)
+    i = j = k = 0
+    while i < len(base) or j < len(HEAD) or k < len(other):
+        n = 0
+        while (i + n < len(base) and matches_HEAD.get(i + n) == j + n
+                and matches_other.get(i + n) == k + n):
+            n += 1
+        if n:
+            yield (i, i + n), (j, j + n), (k, k + n)
+            i, j, k = i + n, j + n, k + n
+            continue
+
+        # find the next base line that both sides still have
+        o = i
+        while o < len(base) and not (o in matches_HEAD and o in matches_other):
+            o += 1
+        if o < len(base):
+            end_HEAD, end_other = matches_HEAD[o], matches_other[o]
+        else:
+            end_HEAD, end_other = len(HEAD), len(other)
+        yield (i, o), (j, end_HEAD), (k, end_other)
+        i, j, k = o, end_HEAD, end_other
+
+
+# map of line number in a to the matching line number in b
+def _get_matches(a, b):
+    matches = {}
+    for tag, i1, i2, j1, _ in _get_opcodes(a, b):
+        if tag == "equal":
+            matches.update(zip(range(i1, i2), range(j1, j1 + i2 - i1)))
+    return matches
+
 
+def _terminated(lines):
+    for line in lines:
+        yield line if line.endswith(b"\n") else line + b"\n"
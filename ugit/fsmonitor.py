@@ -0,0 +1,275 @@
+import os
+import sys
+import errno
+import ctypes
+import struct
+import asyncio
+from . import data
+from . import ignore
+from . import protocol
+
+
+# `ugit fsmonitor` watches the working tree with inotify and tells status which paths changed,
+# so only those get a stat (and maybe a hash) instead of every file in the tree
+#
+# the daemon numbers the changes it sees. a token is "<daemon instance>:<number>", the index
+# keeps the token of its last update and asks for the paths changed since then over a Unix
+# socket in .ugit, using the framing of protocol.py:
+#
+#   client sends {"command": "query", "token": token or null}
+#   daemon replies {"token": new token, "paths": [path]} or {"token": new token, "full": true}
+#
+# "full" means the daemon can't tell (a token from another instance, a lost inotify queue,
+# .ugitignore changed) and the whole tree must be scanned. a reported directory stands for
+# everything under it. {"command": "stop"} makes the daemon exit
+#
+# the socket is only there while a daemon runs, without one status scans the tree as before
+QUERY_TIMEOUT = 1
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+
+# struct inotify_event: wd, mask, cookie, len, followed by len bytes of NUL padded name
+_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def socket_path():
+    return f"{data.GIT_DIR}/fsmonitor.sock"
+
+
+# ask the daemon which paths changed since token
+# return (new token, paths), paths is None if the whole tree must be scanned
+# and the token is None too if no daemon is running
+def query(token):
+    path = socket_path()
+    if not os.path.exists(path):
+        return None, None
+    try:
+        with protocol.Connection(f"{protocol.UNIX_PREFIX}{path}", QUERY_TIMEOUT) as connection:
+            connection.send_message({"command": "query", "token": token})
+            reply = connection.read_message()
+    except (OSError, protocol.ProtocolError) as e:
+        print(f"fsmonitor: {e}, scanning the working tree", file=sys.stderr)
+        return None, None
+    return reply["token"], None if reply.get("full") else reply["paths"]
+
+
+def stop():
+    with protocol.Connection(f"{protocol.UNIX_PREFIX}{socket_path()}", QUERY_TIMEOUT) as connection:
+        connection.send_message({"command": "stop"})
+        connection.read_message()
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this system")
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+    return result
+
+
+def _is_running():
+    try:
+        protocol.Connection(f"{protocol.UNIX_PREFIX}{socket_path()}", QUERY_TIMEOUT).close()
+        return True
+    except OSError:
+        return False
+
+
+# the inotify watches of every directory in the working tree and the changes seen so far
+class _Monitor:
+    def __init__(self):
+        self.libc = _load_libc()
+        self.fd = _check(self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+        self.instance = os.urandom(8).hex()
+        self.seq = 0
+        self.reset_seq = 0
+        # path -> number of the last change seen to it
+        self.changes = {}
+        # wd -> directory and directory -> wd, "" is the top of the working tree
+        self.watches = {}
+        self.dirs = {}
+        # false once a directory couldn't be watched, every query then asks for a full scan
+        self.complete = True
+        self.matcher = ignore.get_matcher()
+        self._watch_tree("")
+
+    def close(self):
+        os.close(self.fd)
+
+    # watch dirpath and every directory under it that isn't ignored
+    # a directory is watched before it's listed, so nothing created in it can be missed
+    def _watch_tree(self, dirpath):
+        if not self._watch(dirpath):
+            return
+        for root, dirnames, _ in ignore.walk(dirpath or ".", self.matcher):
+            prefix = f"{root}/" if root else ""
+            dirnames[:] = [name for name in dirnames if self._watch(prefix + name)]
+
+    def _watch(self, dirpath):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath or "."), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # gone already, or a symlink to a directory (which the index doesn't follow either)
+            if error in (errno.ENOENT, errno.ENOTDIR, errno.ELOOP):
+                return False
+            print(f"fsmonitor: can't watch {dirpath or '.'}: {os.strerror(error)}", file=sys.stderr)
+            self.complete = False
+            return False
+        self.watches[wd] = dirpath
+        self.dirs[dirpath] = wd
+        return True
+
+    def _unwatch_tree(self, dirpath):
+        prefix = f"{dirpath}/"
+        for path in [path for path in self.dirs if path == dirpath or path.startswith(prefix)]:
+            wd = self.dirs.pop(path)
+            del self.watches[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    # forget everything and watch the tree again, tokens from before can only get a full scan
+    def _reset(self):
+        for wd in self.watches:
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches.clear()
+        self.dirs.clear()
+        self.changes.clear()
+        self.seq += 1
+        self.reset_seq = self.seq
+        self.complete = True
+        self.matcher = ignore.get_matcher()
+        self._watch_tree("")
+
+    # read every queued event, called by the event loop when the inotify fd is readable
+    # and before answering a query, so a change made before the query is always reported
+    def read_events(self):
+        while True:
+            try:
+                buffer = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(buffer):
+                wd, mask, _, length = _EVENT.unpack_from(buffer, pos)
+                name = os.fsdecode(buffer[pos + _EVENT.size:pos + _EVENT.size + length].rstrip(b"\0"))
+                pos += _EVENT.size + length
+                self._handle(wd, mask, name)
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            print("fsmonitor: inotify queue overflowed, the next status scans everything", file=sys.stderr)
+            self._reset()
+            return
+        if mask & IN_IGNORED:
+            dirpath = self.watches.pop(wd, None)
+            if dirpath is not None and self.dirs.get(dirpath) == wd:
+                del self.dirs[dirpath]
+            return
+        dirpath = self.watches.get(wd)
+        # events about a watched directory itself are also reported to its parent
+        if dirpath is None or not name:
+            return
+
+        path = f"{dirpath}/{name}" if dirpath else name
+        is_dir = bool(mask & IN_ISDIR)
+        if self.matcher.match(path, is_dir):
+            return
+        if path == ignore.IGNORE_FILE:
+            self._reset()
+            return
+        if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watch_tree(path)
+        elif is_dir and mask & IN_MOVED_FROM:
+            self._unwatch_tree(path)
+        self.seq += 1
+        self.changes[path] = self.seq
+
+    def query(self, token):
+        self.read_events()
+        current = f"{self.instance}:{self.seq}"
+        instance, _, seq = (token or "").partition(":")
+        if not self.complete or instance != self.instance or not seq.isdigit() or int(seq) < self.reset_seq:
+            return {"token": current, "full": True}
+        seq = int(seq)
+        return {"token": current, "paths": sorted(path for path, n in self.changes.items() if n > seq)}
+
+
+# watch the working tree and answer queries on the socket until stopped or interrupted
+def run():
+    path = socket_path()
+    assert not _is_running(), "fsmonitor is already running for this repository"
+    monitor = _Monitor()
+
+    async def handle(reader, writer, stop):
+        try:
+            while True:
+                try:
+                    kind, payload = await protocol.read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                request = protocol.decode_message(kind, payload)
+                command = request.get("command")
+                if command == "query":
+                    reply = monitor.query(request.get("token"))
+                elif command == "stop":
+                    reply = {"ok": True}
+                    if not stop.done():
+                        stop.set_result(None)
+                else:
+                    reply = {"error": f"Unknown command {command!r}"}
+                writer.write(protocol.encode_message(reply))
+                await writer.drain()
+        except (ConnectionError, protocol.ProtocolError) as e:
+            print(f"fsmonitor: {e}", file=sys.stderr)
+        finally:
+            writer.close()
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_reader(monitor.fd, monitor.read_events)
+        async with await asyncio.start_unix_server(lambda r, w: handle(r, w, stop), path):
+            print(f"Watching {len(monitor.dirs)} directories of {os.getcwd()} on {path}", file=sys.stderr)
+            await stop
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close()
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,146 @@
+import os
+import re
+
+
+# Ignore rules, read from .ugitignore at the top of the working tree with gitignore syntax:
+#
+#   # comment        blank lines and lines starting with # are skipped
+#   *.pyc            a pattern without a slash matches a name at any depth
+#   /build           a leading (or middle) slash anchors the pattern to the top directory
+#   cache/           a trailing slash only matches directories
+#   docs/**/*.tmp    * and ? don't match "/", ** matches any number of directories
+#   !keep.pyc        negates an earlier pattern, the last matching pattern wins
+#
+# everything under an ignored directory is ignored, a file can't be re-included if a parent
+# directory is ignored. the walkers rely on this and don't descend into ignored directories
+IGNORE_FILE = ".ugitignore"
+DEFAULTS = (".ugit/", ".git/", "env", "ugit")
+
+_matcher = None
+_matcher_key = None
+
+
+# all patterns are compiled into 2 regexes (one for files, one for directories) made of an
+# alternative per pattern in reverse order, so the first alternative that matches is the last
+# pattern of the file, and whether it's negated tells the answer
+class Matcher:
+    def __init__(self, lines):
+        patterns = [p for p in (_parse(line) for line in lines) if p]
+        self.negated = {}
+        files, dirs = [], []
+        for i, (regex, negate, dir_only) in reversed(list(enumerate(patterns))):
+            alternative = f"(?P<p{i}>{regex})"
+            self.negated[f"p{i}"] = negate
+            dirs.append(alternative)
+            if not dir_only:
+                files.append(alternative)
+        self._files = re.compile("|".join(files)) if files else None
+        self._dirs = re.compile("|".join(dirs)) if dirs else None
+
+    # check path (relative to the top directory, "/" separated) without looking at its parents
+    def match(self, path, is_dir=False):
+        regex = self._dirs if is_dir else self._files
+        m = regex and regex.fullmatch(path)
+        return bool(m) and not self.negated[m.lastgroup]
+
+    # check path and each directory above it
+    def is_ignored(self, path, is_dir=False):
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            if self.match("/".join(parts[:i]), True):
+                return True
+        return self.match(path, is_dir)
+
+
+# return the matcher for the current working tree, compiled again only when .ugitignore changes
+def get_matcher():
+    global _matcher, _matcher_key
+    try:
+        st = os.stat(IGNORE_FILE)
+        key = (os.path.abspath(IGNORE_FILE), st.st_size, st.st_mtime_ns, st.st_ino)
+    except FileNotFoundError:
+        key = None
+    if _matcher is None or key != _matcher_key:
+        lines = list(DEFAULTS)
+        if key:
+            with open(IGNORE_FILE) as f:
+                lines.extend(f.read().splitlines())
+        _matcher, _matcher_key = Matcher(lines), key
+    return _matcher
+
+
+# turn one line of .ugitignore into (regex, negate, dir_only), or None for blanks and comments
+def _parse(line):
+    line = line.rstrip("\n")
+    # trailing spaces are ignored unless escaped
+    while line.endswith(" ") and not line.endswith("\\ "):
+        line = line[:-1]
+    if not line or line.startswith("#"):
+        return None
+
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    elif line.startswith("\\"):
+        line = line[1:] if line[1:2] in ("#", "!") else line
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+
+    anchored = "/" in line
+    line = line.lstrip("/")
+    regex = _translate(line)
+    if not anchored:
+        regex = f"(?:.*/)?{regex}"
+    return regex, negate, dir_only
+
+
+# translate a glob to a regex, "*" and "?" stop at "/" and "**" crosses directories
+def _translate(glob):
+    out = []
+    i, n = 0, len(glob)
+    while i < n:
+        c = glob[i]
+        if glob.startswith("**/", i) and (i == 0 or glob[i - 1] == "/"):
+            out.append("(?:.*/)?")
+            i += 3
+        elif glob.startswith("**", i) and i + 2 == n and (i == 0 or glob[i - 1] == "/"):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[":
+            negate = glob[i + 1:i + 2] in ("!", "^")
+            # a "]" right after the opening bracket is part of the set
+            end = glob.find("]", i + 2 + negate)
+            if end == -1:
+                out.append(re.escape(c))
+                i += 1
+                continue
+            chars = "".join(ch if ch == "-" else re.escape(ch) for ch in glob[i + 1 + negate:end])
+            out.append(f"[{'^' if negate else ''}{chars}]")
+            i = end + 1
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(glob[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+
+# os.walk of top (relative to the top of the working tree) that leaves out ignored files and prunes
+# ignored directories before descending, yields (dirpath, dirnames, filenames) with "" for the top
+# directory and "/" separated paths otherwise. dirnames can be pruned further by the caller
+def walk(top=".", matcher=None):
+    matcher = matcher or get_matcher()
+    for root, dirnames, filenames in os.walk(top):
+        dirpath = "" if root == "." else root[2:] if root.startswith("./") else root
+        prefix = f"{dirpath}/" if dirpath else ""
+        dirnames[:] = [name for name in dirnames if not matcher.match(prefix + name, True)]
+        yield dirpath, dirnames, [name for name in filenames if not matcher.match(prefix + name)]
@@ -0,0 +1,300 @@
+import os
+import mmap
+import zlib
+import struct
+import hashlib
+from collections import namedtuple
+
+
+# A pack is 2 files: pack-<name>.pack holds the objects one after another and
+# pack-<name>.idx holds a 256 entry fan-out table, the sorted oids and their offsets in the pack
+#
+# .pack: PACK_MAGIC | version, count | entry... | sha1 of everything before
+# .idx:  IDX_MAGIC | version | fanout[256] | oid[count] (20 bytes each) | offset[count]
+#
+# version 1 entries are (length, type\x00content)
+# version 2 entries are (length, zlib(type\x00content)), the same as loose objects
+# version 3 entries are (kind, length, payload), where payload is zlib(type\x00content) for FULL
+# entries and base oid (20 bytes) + zlib(delta) for DELTA entries (see delta.py). the type of a
+# delta is the type of its base, which can itself be a delta
+#
+# packs streamed between repositories are version 2, so the receiver can hash every object as it arrives
+PACK_MAGIC = b"PACK"
+IDX_MAGIC = b"UIDX"
+VERSION = 3
+STREAM_VERSION = 2
+
+FULL = 0
+DELTA = 1
+
+_HEADER = struct.Struct(">II")
+_FANOUT = struct.Struct(">256I")
+_LENGTH = struct.Struct(">I")
+_ENTRY = struct.Struct(">BI")
+_OFFSET = struct.Struct(">Q")
+_FANOUT_START = len(IDX_MAGIC) + 4
+_OIDS_START = _FANOUT_START + _FANOUT.size
+
+
+Pack = namedtuple("Pack", ["name", "pack", "idx", "fanout", "count", "version"])
+
+
+# mmap a pack and its index (given the path to the .idx), the returned Pack is used for all lookups
+def open_pack(path):
+    name = path[:-len(".idx")]
+    with open(f"{name}.idx", "rb") as f:
+        idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(f"{name}.pack", "rb") as f:
+        pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    assert idx[:len(IDX_MAGIC)] == IDX_MAGIC, f"Bad pack index {name}.idx"
+    assert pack[:len(PACK_MAGIC)] == PACK_MAGIC, f"Bad pack {name}.pack"
+    fanout = _FANOUT.unpack_from(idx, _FANOUT_START)
+    version, _ = _HEADER.unpack_from(pack, len(PACK_MAGIC))
+    return Pack(name=name, pack=pack, idx=idx, fanout=fanout, count=fanout[255], version=version)
+
+
+def close_pack(pack):
+    pack.idx.close()
+    pack.pack.close()
+
+
+# binary search the sorted oid table of a pack, only between the fan-out bounds of the first byte
+def find_offset(pack, oid):
+    key = bytes.fromhex(oid)
+    lo = pack.fanout[key[0] - 1] if key[0] else 0
+    hi = pack.fanout[key[0]]
+    idx = pack.idx
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = _OIDS_START + mid * 20
+        current = idx[start:start + 20]
+        if current < key:
+            lo = mid + 1
+        elif current > key:
+            hi = mid
+        else:
+            return _OFFSET.unpack_from(idx, _OIDS_START + pack.count * 20 + mid * _OFFSET.size)[0]
+    return None
+
+
+# return kind, start and end of the payload of the entry at offset
+def _entry_at(pack, offset):
+    if pack.version < 3:
+        length, = _LENGTH.unpack_from(pack.pack, offset)
+        start = offset + _LENGTH.size
+        return FULL, start, start + length
+    kind, length = _ENTRY.unpack_from(pack.pack, offset)
+    start = offset + _ENTRY.size
+    return kind, start, start + length
+
+
+# yield the compressed object stored at offset in chunks (it must not be a delta)
+def iter_at(pack, offset, chunk_size):
+    kind, start, end = _entry_at(pack, offset)
+    assert kind == FULL, "Can't read a delta as a full object"
+    if pack.version < 2:
+        yield zlib.compress(pack.pack[start:end])
+        return
+    for i in range(start, end, chunk_size):
+        yield pack.pack[i:min(i + chunk_size, end)]
+
+
+# return the oid of the base of the object at offset if it's stored as a delta, otherwise None
+def delta_base(pack, offset):
+    kind, start, _ = _entry_at(pack, offset)
+    if kind != DELTA:
+        return None
+    return pack.pack[start:start + 20].hex()
+
+
+def read_delta(pack, offset):
+    kind, start, end = _entry_at(pack, offset)
+    assert kind == DELTA, "Not a delta"
+    return zlib.decompress(pack.pack[start + 20:end])
+
+
+# yield every oid in a pack in sorted order
+def iter_oids(pack):
+    for i in range(pack.count):
+        yield oid_at(pack, i)
+
+
+def oid_at(pack, i):
+    start = _OIDS_START + i * 20
+    return pack.idx[start:start + 20].hex()
+
+
+# position of the first oid in the pack that is >= prefix (hex string, can be shorter than an oid)
+def lower_bound(pack, prefix):
+    lo, hi = 0, pack.count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if oid_at(pack, mid) < prefix:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+# write objects into a new pack inside pack_dir. objects is an iterable of (oid, base, compressed)
+# where compressed is zlib(type\x00content) if base is None, otherwise the zlib compressed delta
+# from the object base. returns the path to the .pack file
+def write_pack(pack_dir, objects):
+    os.makedirs(pack_dir, exist_ok=True)
+    tmp = f"{pack_dir}/tmp_pack_{os.getpid()}"
+    offsets = {}
+    with open(tmp, "wb") as out:
+        out.write(PACK_MAGIC + _HEADER.pack(VERSION, 0))
+        offset = len(PACK_MAGIC) + _HEADER.size
+        for oid, base, obj in objects:
+            if oid in offsets:
+                continue
+            offsets[oid] = offset
+            if base is None:
+                entry = _ENTRY.pack(FULL, len(obj))
+            else:
+                entry = _ENTRY.pack(DELTA, 20 + len(obj)) + bytes.fromhex(base)
+            out.write(entry)
+            out.write(obj)
+            offset += len(entry) + len(obj)
+
+        # now that we know how many objects were written, fix the count in the header
+        out.seek(len(PACK_MAGIC))
+        out.write(_HEADER.pack(VERSION, len(offsets)))
+
+    # trailer is the checksum of everything before it
+    checksum = _checksum_file(tmp)
+    with open(tmp, "ab") as out:
+        out.write(checksum.digest())
+
+    # readers look for .idx files, so the index goes in place last
+    oids = sorted(offsets)
+    name = f"{pack_dir}/pack-{hashlib.sha1(''.join(oids).encode()).hexdigest()}"
+    os.replace(tmp, f"{name}.pack")
+    _write_idx(f"{name}.idx", oids, offsets)
+    return f"{name}.pack"
+
+
+# yield a pack of count compressed objects as a stream of chunks, for sending to another repository
+def iter_pack(objects, count):
+    checksum = hashlib.sha1()
+    header = PACK_MAGIC + _HEADER.pack(STREAM_VERSION, count)
+    checksum.update(header)
+    yield header
+    for obj in objects:
+        length = _LENGTH.pack(len(obj))
+        checksum.update(length)
+        checksum.update(obj)
+        yield length + obj
+    yield checksum.digest()
+
+
+# read a pack stream with read(n) and store it inside pack_dir, verifying every object and
+# the trailer checksum as it arrives. progress(objects, bytes) is called after each object
+# returns the path to the .pack file (None if the pack is empty) and the number of objects
+def index_pack(read, pack_dir, progress=None, chunk_size=1 << 16):
+    os.makedirs(pack_dir, exist_ok=True)
+    tmp = f"{pack_dir}/tmp_pack_{os.getpid()}_{id(read)}"
+    checksum = hashlib.sha1()
+    offsets = {}
+    try:
+        with open(tmp, "wb") as out:
+            def copy(n):
+                chunk = _read_exact(read, n)
+                checksum.update(chunk)
+                out.write(chunk)
+                return chunk
+
+            header = copy(len(PACK_MAGIC) + _HEADER.size)
+            assert header[:len(PACK_MAGIC)] == PACK_MAGIC, "Bad pack stream"
+            version, count = _HEADER.unpack_from(header, len(PACK_MAGIC))
+            assert version == STREAM_VERSION, f"Unsupported pack stream version {version}"
+
+            offset = len(header)
+            for received in range(1, count + 1):
+                length, = _LENGTH.unpack(copy(_LENGTH.size))
+                # the oid is the hash of the decompressed object, so hash it while copying
+                sha = hashlib.sha1()
+                decompressor = zlib.decompressobj()
+                remaining = length
+                while remaining:
+                    chunk = copy(min(chunk_size, remaining))
+                    remaining -= len(chunk)
+                    while chunk:
+                        sha.update(decompressor.decompress(chunk, chunk_size))
+                        chunk = decompressor.unconsumed_tail
+                sha.update(decompressor.flush())
+                assert decompressor.eof, "Truncated object in pack stream"
+                offsets.setdefault(sha.hexdigest(), offset)
+                offset += _LENGTH.size + length
+                if progress:
+                    progress(received, offset)
+
+            trailer = _read_exact(read, checksum.digest_size)
+            assert trailer == checksum.digest(), "Pack stream checksum mismatch"
+            out.write(trailer)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+    if not offsets:
+        os.remove(tmp)
+        return None, 0
+
+    oids = sorted(offsets)
+    name = f"{pack_dir}/pack-{hashlib.sha1(''.join(oids).encode()).hexdigest()}"
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, f"{name}.pack")
+    _write_idx(f"{name}.idx", oids, offsets)
+    return f"{name}.pack", count
+
+
+def _read_exact(read, n):
+    chunk = read(n)
+    while len(chunk) < n:
+        more = read(n - len(chunk))
+        assert more, "Unexpected end of pack stream"
+        chunk += more
+    return chunk
+
+
+# return a read(n) function over an iterable of byte chunks
+def chunk_reader(chunks):
+    chunks = iter(chunks)
+    buffer = bytearray()
+
+    def read(n):
+        while len(buffer) < n:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            buffer.extend(chunk)
+        result = bytes(buffer[:n])
+        del buffer[:n]
+        return result
+
+    return read
+
+
+def _write_idx(path, oids, offsets):
+    fanout = [0] * 256
+    for oid in oids:
+        fanout[int(oid[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    with open(f"{path}.lock", "wb") as out:
+        out.write(IDX_MAGIC + struct.pack(">I", VERSION))
+        out.write(_FANOUT.pack(*fanout))
+        out.write(b"".join(bytes.fromhex(oid) for oid in oids))
+        out.write(b"".join(_OFFSET.pack(offsets[oid]) for oid in oids))
+    os.replace(f"{path}.lock", path)
+
+
+def _checksum_file(path):
+    checksum = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            checksum.update(chunk)
+    return checksum
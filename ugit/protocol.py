@@ -0,0 +1,127 @@
+import json
+import shlex
+import socket
+import struct
+import subprocess
+
+
+# Messages between a client and `ugit serve` are framed as: kind (1 byte) | length | payload
+# MESSAGE frames hold a JSON object, PACK frames hold the next chunk of a pack stream
+#
+# on connect the server advertises its refs: {"refs": {name: oid}}
+# fetch: client sends {"command": "fetch", "wants": [oid], "haves": [oid]}
+#        server replies {"objects": count} followed by the pack in PACK frames
+# push:  client sends {"command": "push", "ref": name, "old": oid or null, "new": oid, "objects": count}
+#        followed by the pack in PACK frames, server replies {"ok": true}
+# any request can be answered with {"error": message} instead
+MESSAGE = b"M"
+PACK = b"P"
+
+_FRAME = struct.Struct(">cI")
+
+# remotes starting with these are served by `ugit serve`, anything else is a path to a repository
+UNIX_PREFIX = "unix:"
+STDIO_PREFIX = "stdio:"
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def is_served(remote):
+    return remote.startswith((UNIX_PREFIX, STDIO_PREFIX))
+
+
+def encode_frame(kind, payload):
+    return _FRAME.pack(kind, len(payload)) + payload
+
+
+def encode_message(message):
+    return encode_frame(MESSAGE, json.dumps(message).encode())
+
+
+# parse a MESSAGE payload, raise ProtocolError if the other side reported an error
+def decode_message(kind, payload):
+    if kind != MESSAGE:
+        raise ProtocolError(f"Expected a message, got a {kind!r} frame")
+    message = json.loads(payload)
+    if "error" in message:
+        raise ProtocolError(message["error"])
+    return message
+
+
+async def read_frame(reader):
+    kind, length = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+    return kind, await reader.readexactly(length)
+
+
+# blocking client side of a connection to `ugit serve`
+# remote is "unix:<socket path>" or "stdio:<command running `ugit serve --stdio`>"
+# timeout (seconds) applies to connecting and each read or write on a Unix socket
+class Connection:
+    def __init__(self, remote, timeout=None):
+        self._process = None
+        self._socket = None
+        if remote.startswith(UNIX_PREFIX):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(timeout)
+            try:
+                self._socket.connect(remote[len(UNIX_PREFIX):])
+            except OSError:
+                self._socket.close()
+                raise
+            self._reader = self._socket.makefile("rb")
+            self._writer = self._socket.makefile("wb")
+        else:
+            command = remote[len(STDIO_PREFIX):]
+            self._process = subprocess.Popen(
+                shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            self._reader = self._process.stdout
+            self._writer = self._process.stdin
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._writer.close()
+        self._reader.close()
+        if self._socket:
+            self._socket.close()
+        if self._process:
+            self._process.wait()
+
+    def read_frame(self):
+        header = self._reader.read(_FRAME.size)
+        if len(header) < _FRAME.size:
+            raise ProtocolError("Connection closed by server")
+        kind, length = _FRAME.unpack(header)
+        payload = self._reader.read(length)
+        if len(payload) < length:
+            raise ProtocolError("Connection closed by server")
+        return kind, payload
+
+    def read_message(self):
+        return decode_message(*self.read_frame())
+
+    def send_message(self, message):
+        self._writer.write(encode_message(message))
+        self._writer.flush()
+
+    # yield the chunks of a pack stream sent by the server
+    def iter_pack(self):
+        while True:
+            kind, payload = self.read_frame()
+            if kind != PACK:
+                decode_message(kind, payload)
+                raise ProtocolError("Unexpected message inside a pack stream")
+            yield payload
+
+    def send_pack_chunk(self, chunk):
+        self._writer.write(encode_frame(PACK, chunk))
+
+    def flush(self):
+        self._writer.flush()
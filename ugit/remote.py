@@ -1,6 +1,10 @@
 import os
+import sys
+import time
 from . import data
 from . import base
+from . import protocol
+from . import trace
 
 
 # Where to fetch the remote refs from
@@ -9,44 +13,153 @@ REMOTE_REFS_BASE = "refs/heads/"
 LOCAL_REFS_BASE = "refs/remote/"
 
 
+# remote_path is a path to a repository on the filesystem, or a `ugit serve` address
+# ("unix:<socket path>" or "stdio:<command>", see protocol.py)
 def fetch(remote_path):
-    # Get refs from server
-    refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+    if protocol.is_served(remote_path):
+        refs = _fetch_served(remote_path)
+    else:
+        refs = _fetch_local(remote_path)
 
-    # Fetch missing objects by iterating and fetching on demand
-    for oid in base.iter_objects_in_commits(refs.values()):
-        data.fetch_object_if_missing(oid, remote_path)
     # Update local refs to match server
     for remote_name, value in refs.items():
         refname = os.path.relpath(remote_name, REMOTE_REFS_BASE)
         data.update_ref(
-            f"{LOCAL_REFS_BASE}/{refname}",
+            f"{LOCAL_REFS_BASE}{refname}",
             data.RefValue(symbolic=False, value=value)
         )
 
+
+def _fetch_local(remote_path):
+    # Get refs from server
+    refs = _get_remote_refs(remote_path, REMOTE_REFS_BASE)
+
+    # Walk the server's history, stopping at commits and trees we already have,
+    # and receive everything missing as a single pack
+    local_path = os.path.dirname(data.GIT_DIR)
+    local_refs = {ref.value for _, ref in data.iter_refs(deref=True)}
+
+    def local_has(oid):
+        with data.change_git_dir(local_path):
+            return data.object_exist(oid)
+
+    with data.change_git_dir(remote_path), trace.phase("negotiate"):
+        oids = list(base.iter_missing_objects(refs.values(), local_refs, local_has))
+    if oids:
+        _receive(data.iter_pack_stream(oids, remote_path), len(oids))
+    return refs
+
+
+# the server can't look into our object store, so we tell it which commits we have
+def _fetch_served(remote):
+    with protocol.Connection(remote) as conn:
+        refs = {
+            name: oid for name, oid in conn.read_message()["refs"].items()
+            if name.startswith(REMOTE_REFS_BASE)
+        }
+        local_refs = {ref.value for _, ref in data.iter_refs(deref=True)}
+        conn.send_message({"command": "fetch", "wants": sorted(set(refs.values())), "haves": sorted(local_refs)})
+        count = conn.read_message()["objects"]
+        if count:
+            _receive(conn.iter_pack(), count)
+    return refs
+
+
 # push all object files for a branch to a remote branch
 def push(remote_path, refname):
-    # Get refs data (oid)
-    remote_refs = _get_remote_refs(remote_path)
     local_ref = data.get_ref(refname).value
     assert local_ref
+    if protocol.is_served(remote_path):
+        _push_served(remote_path, refname, local_ref)
+        return
 
-    # Compute which objects the remote doesn't have
-    known_remote_refs = filter(data.object_exist, remote_refs.values())
-    remote_objects = set(base.iter_objects_in_commits(known_remote_refs))
-    local_objects = set(base.iter_objects_in_commits({local_ref}))
+    # Get refs data (oid)
+    remote_refs = _get_remote_refs(remote_path)
 
-    # outer left join
-    objects_to_push = local_objects - remote_objects
-    # Push all objects to remote
-    for oid in objects_to_push:
-        data.push_object(oid, remote_path)
+    # Walk from our branch and stop at commits and trees the remote already has
+    def remote_has(oid):
+        with data.change_git_dir(remote_path):
+            return data.object_exist(oid)
+
+    with trace.phase("negotiate"):
+        oids = list(base.iter_missing_objects({local_ref}, remote_refs.values(), remote_has))
+    if oids:
+        stream = data.iter_pack_stream(oids, os.path.dirname(data.GIT_DIR))
+        with data.change_git_dir(remote_path):
+            _receive(stream, len(oids))
 
     # Update remote ref to point at our target branch oid
     with data.change_git_dir(remote_path):
         data.update_ref(refname, data.RefValue(symbolic=False, value=local_ref))
 
 
+# the server only moves the ref if it still points where its advertisement said
+def _push_served(remote, refname, local_ref):
+    with protocol.Connection(remote) as conn:
+        remote_refs = conn.read_message()["refs"]
+        haves = [oid for oid in set(remote_refs.values()) if data.object_exist(oid)]
+        with trace.phase("negotiate"):
+            oids = list(base.iter_objects_excluding([local_ref], haves))
+        conn.send_message({
+            "command": "push", "ref": refname, "old": remote_refs.get(refname),
+            "new": local_ref, "objects": len(oids),
+        })
+        if oids:
+            progress, done = _progress(len(oids))
+            sent = 0
+            with trace.phase("send_pack"):
+                # the first chunk is the pack header, then one chunk per object
+                for i, chunk in enumerate(data.iter_pack_stream(oids)):
+                    conn.send_pack_chunk(chunk)
+                    sent += len(chunk)
+                    progress(min(i, len(oids)), sent)
+                conn.flush()
+            done()
+        conn.read_message()
+
+
 def _get_remote_refs(remote_path, prefix=""):
     with data.change_git_dir(remote_path):
         return {refname: ref.value for refname, ref in data.iter_refs(prefix)}
+
+
+# store an incoming pack stream in GIT_DIR and print transfer counters
+def _receive(chunks, total):
+    progress, done = _progress(total)
+    with trace.phase("receive_pack"):
+        data.receive_pack(chunks, progress)
+    done()
+
+
+# return a progress(objects, bytes) callback, showing live counters when stderr is a terminal,
+# and a function printing the totals and throughput once the transfer is done
+def _progress(total):
+    started = time.monotonic()
+    last_report = started
+    totals = [0, 0]
+
+    def progress(objects, transferred):
+        nonlocal last_report
+        now = time.monotonic()
+        if sys.stderr.isatty() and now - last_report > 0.5:
+            last_report = now
+            print(f"\rObjects: {objects}/{total}, {_format_bytes(transferred)}", end="", file=sys.stderr)
+        totals[:] = objects, transferred
+
+    def done():
+        elapsed = max(time.monotonic() - started, 1e-6)
+        if last_report != started:
+            print(file=sys.stderr)
+        objects, transferred = totals
+        print(f"Transferred {objects} objects, {_format_bytes(transferred)} in {elapsed:.2f}s "
+              f"({_format_bytes(transferred / elapsed)}/s)")
+
+    return progress, done
+
+
+def _format_bytes(n):
+    for unit in ("bytes", "KiB", "MiB"):
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "bytes" else f"{n:.2f} {unit}"
+        n /= 1024
+    return f"{n:.2f} GiB"
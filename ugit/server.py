@@ -0,0 +1,176 @@
+import os
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from . import data
+from . import base
+from . import pack
+from . import protocol
+
+
+# `ugit serve` answers fetch and push requests for the repository it runs in (see protocol.py)
+#
+# the network side of every connection runs concurrently on the event loop. everything that
+# reads or changes the repository runs on a single worker thread, so GIT_DIR never changes
+# and packs are never reloaded while another request reads from them
+#
+# size of the pack chunks read from the repository at once and sent as PACK frames
+BATCH_SIZE = 1 << 20
+
+
+class _Server:
+    def __init__(self):
+        self.repo = ThreadPoolExecutor(max_workers=1)
+
+    # run func(*args) on the repository thread
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.repo, func, *args)
+
+    async def handle(self, reader, writer):
+        try:
+            refs = await self.run(_advertise)
+            await _send(writer, protocol.encode_message({"refs": refs}))
+            while True:
+                try:
+                    kind, payload = await protocol.read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                request = protocol.decode_message(kind, payload)
+                command = request.get("command")
+                try:
+                    if command == "fetch":
+                        await self.fetch(request, writer)
+                    elif command == "push":
+                        await self.push(request, reader, writer)
+                    else:
+                        raise protocol.ProtocolError(f"Unknown command {command!r}")
+                except (AssertionError, protocol.ProtocolError) as e:
+                    # a failed push can leave pack frames unread, so the connection ends here
+                    await _send(writer, protocol.encode_message({"error": str(e) or type(e).__name__}))
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError) as e:
+            print(f"serve: {e}", file=sys.stderr)
+        finally:
+            writer.close()
+
+    async def fetch(self, request, writer):
+        oids = await self.run(_missing_objects, request["wants"], request["haves"])
+        await _send(writer, protocol.encode_message({"objects": len(oids)}))
+        if not oids:
+            return
+
+        stream = data.iter_pack_stream(oids)
+        while True:
+            chunks = await self.run(_next_batch, stream)
+            if not chunks:
+                break
+            await _send(writer, b"".join(protocol.encode_frame(protocol.PACK, chunk) for chunk in chunks))
+
+    async def push(self, request, reader, writer):
+        if request["objects"]:
+            # indexing only touches the new pack file, so it runs on its own thread and
+            # pulls frames from this connection through the event loop
+            loop = asyncio.get_running_loop()
+            read = _frame_reader(reader, loop)
+            pack_dir = f"{data.GIT_DIR}/objects/pack"
+            await loop.run_in_executor(None, pack.index_pack, read, pack_dir, None, data.CHUNK_SIZE)
+        await self.run(_update_ref, request["ref"], request["old"], request["new"], bool(request["objects"]))
+        await _send(writer, protocol.encode_message({"ok": True}))
+
+
+async def _send(writer, payload):
+    writer.write(payload)
+    await writer.drain()
+
+
+# return a blocking read(n) for pack.index_pack, reading PACK frames from the event loop thread
+def _frame_reader(reader, loop):
+    buffer = bytearray()
+
+    async def read_async(n):
+        while len(buffer) < n:
+            kind, payload = await protocol.read_frame(reader)
+            if kind != protocol.PACK:
+                raise protocol.ProtocolError("Expected pack data")
+            buffer.extend(payload)
+        chunk = bytes(buffer[:n])
+        del buffer[:n]
+        return chunk
+
+    def read(n):
+        return asyncio.run_coroutine_threadsafe(read_async(n), loop).result()
+
+    return read
+
+
+# refs can be moved by other processes at any time, so they're read again for every client
+def _advertise():
+    data.reload_refs()
+    return {name: ref.value for name, ref in data.iter_refs(deref=True)}
+
+
+def _missing_objects(wants, haves):
+    for oid in wants:
+        assert data.object_exist(oid), f"Unknown object {oid}"
+    # the client can have commits we've never seen, those can't limit the walk
+    haves = [oid for oid in haves if data.object_exist(oid)]
+    return list(base.iter_objects_excluding(wants, haves))
+
+
+def _next_batch(stream):
+    chunks, size = [], 0
+    for chunk in stream:
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= BATCH_SIZE:
+            break
+    return chunks
+
+
+# move ref from old to new, refusing if someone else moved it since the client read it
+def _update_ref(ref, old, new, received):
+    if received:
+        data.reload_packs()
+    assert ref.startswith("refs/"), f"Can't push to {ref}"
+    data.check_ref_name(ref)
+    assert data.object_exist(new), f"Missing object {new}"
+    try:
+        data.update_ref_if(ref, old, new)
+    except AssertionError as e:
+        raise AssertionError(f"{e}, fetch first")
+
+
+# serve clients on a Unix socket until interrupted
+def serve_socket(path):
+    server = _Server()
+
+    async def main():
+        async with await asyncio.start_unix_server(server.handle, path):
+            print(f"Serving {os.path.abspath(os.path.dirname(data.GIT_DIR))} on {path}", file=sys.stderr)
+            await asyncio.Future()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.repo.shutdown()
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# serve a single client talking over stdin and stdout
+def serve_stdio():
+    server = _Server()
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        transport, stream_protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin, sys.stdout
+        )
+        writer = asyncio.StreamWriter(transport, stream_protocol, reader, loop)
+        await server.handle(reader, writer)
+
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+from collections import defaultdict
+from . import cache
+
+
+# Tracing of ugit commands, enabled with UGIT_TRACE=<dest>, --trace or --trace-json <path>
+# dest "1" or "summary" (what --trace sets) prints a summary on stderr when the command ends,
+# anything else is a path to write Chrome trace-event JSON to (open it in chrome://tracing or Perfetto)
+#
+# phases are timed with `with trace.phase(name):` and counters are bumped on hot paths with
+# `if trace.ENABLED: trace.count(name, n)`, so a disabled trace costs a global lookup per call
+ENABLED = False
+SUMMARY = ("1", "summary")
+
+_dest = None
+_started = None
+_depth = 0
+# (name, start, duration, depth, thread id) of finished phases
+_phases = []
+_counters = defaultdict(int)
+_NOOP = contextlib.nullcontext()
+
+
+def start(dest):
+    global ENABLED, _dest, _started
+    if not dest or dest == "0":
+        return
+    ENABLED = True
+    _dest = dest
+    _started = time.perf_counter()
+
+
+def phase(name):
+    if not ENABLED:
+        return _NOOP
+    return _phase(name)
+
+
+@contextlib.contextmanager
+def _phase(name):
+    global _depth
+    start = time.perf_counter()
+    _depth += 1
+    try:
+        yield
+    finally:
+        _depth -= 1
+        _phases.append((name, start, time.perf_counter() - start, _depth, threading.get_ident()))
+
+
+def count(name, n=1):
+    _counters[name] += n
+
+
+# write the trace out and disable tracing
+def finish():
+    global ENABLED
+    if not ENABLED:
+        return
+    ENABLED = False
+    if _dest not in SUMMARY:
+        with open(_dest, "w") as f:
+            json.dump(_chrome_trace(), f)
+        print(f"trace: written to {_dest}", file=sys.stderr)
+    else:
+        _print_summary(sys.stderr)
+
+
+def _print_summary(out):
+    print(f"trace: {time.perf_counter() - _started:.6f}s total", file=out)
+
+    # phases with the same name at the same depth are added up, in the order they started
+    totals = {}
+    for name, start, duration, depth, _ in sorted(_phases, key=lambda p: p[1]):
+        calls, total = totals.get((depth, name), (0, 0))
+        totals[(depth, name)] = calls + 1, total + duration
+    if totals:
+        print(f"  {'phase':<40} {'calls':>8} {'seconds':>12}", file=out)
+    for (depth, name), (calls, total) in totals.items():
+        print(f"  {'  ' * depth + name:<40} {calls:>8} {total:>12.6f}", file=out)
+
+    if _counters:
+        print(f"  {'counter':<40} {'value':>8}", file=out)
+    for name, value in sorted(_counters.items()):
+        print(f"  {name:<40} {value:>8}", file=out)
+
+    print(f"  {'cache':<20} {'hits':>8} {'misses':>8} {'entries':>8} {'bytes':>12}", file=out)
+    for name, stats in cache.stats().items():
+        print(f"  {name:<20} {stats['hits']:>8} {stats['misses']:>8} {stats['entries']:>8} "
+              f"{stats['bytes']:>12}", file=out)
+
+
+def _chrome_trace():
+    pid = os.getpid()
+    events = [
+        {
+            "name": name, "ph": "X", "pid": pid, "tid": tid,
+            "ts": (start - _started) * 1e6, "dur": duration * 1e6,
+        }
+        for name, start, duration, _, tid in _phases
+    ]
+    end = (time.perf_counter() - _started) * 1e6
+    events.append({"name": "counters", "ph": "C", "pid": pid, "ts": end, "args": dict(_counters)})
+    for name, stats in cache.stats().items():
+        events.append({
+            "name": f"cache {name}", "ph": "C", "pid": pid, "ts": end,
+            "args": {"hits": stats["hits"], "misses": stats["misses"]},
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}